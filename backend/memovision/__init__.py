@@ -39,6 +39,7 @@ def create_app():
     from memovision.auth.routes import auth
     from memovision.features.dynamics import dynamics
     from memovision.features.rhythm import rhythm
+    from memovision.jobs.routes import jobs
     from memovision.session_selector.routes import session_selector
 
     app.register_blueprint(region_selector, url_prefix='/api')
@@ -54,5 +55,10 @@ def create_app():
     app.register_blueprint(dynamics, url_prefix='/api')
     app.register_blueprint(session_selector, url_prefix='/api')
     app.register_blueprint(admin, url_prefix='/api')
+    app.register_blueprint(jobs, url_prefix='/api')
+
+    if Config.PRELOAD_MODELS:
+        from memovision.model_registry import warm_up
+        warm_up(Config.PRELOAD_MODELS)
 
     return app
@@ -7,6 +7,7 @@ from flask_jwt_extended import current_user, jwt_required
 
 from memovision.db_models import Session, Track
 from memovision.features.utils import load_measures
+from memovision.warping_path import load_time_map
 
 interp_player = Blueprint('interp_player', __name__)
 
@@ -41,16 +42,16 @@ def sync_points():
                                      track.filename, track.gt_measures)
             positions = create_positions(measures, track.length_sec)
             lin_axis.append(positions)
-            wp = np.load(
-                f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/wp.npy'
+            ref_times, target_times = load_time_map(
+                f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features'
             )
             target_positions = scipy.interpolate.interp1d(
-                wp[0] / 50, wp[1] / 50, kind='linear')(ref_positions)
+                ref_times, target_times, kind='linear')(ref_positions)
             target_positions = list(
                 np.clip(target_positions, 0., track.length_sec))
 
             target_positions_backref = scipy.interpolate.interp1d(
-                wp[1] / 50, wp[0] / 50, kind='linear')(positions)
+                target_times, ref_times, kind='linear')(positions)
             target_positions_backref = list(
                 np.clip(target_positions_backref, 0., ref_track.length_sec))
 
@@ -2,15 +2,29 @@ import os
 import zipfile
 
 import numpy as np
-from flask import Blueprint, jsonify, send_from_directory
+from flask import (Blueprint, jsonify, request, send_file,
+                   send_from_directory)
 from flask_jwt_extended import current_user, jwt_required
+from memovision.blob_store import artifact_etag
 from memovision.db_models import Session, TimeSignature, Track, TrackRegion
+from memovision.waveform import select_level, waveform_peaks
 
 from memovision import db
 
 fetch_routes = Blueprint('fetch_routes', __name__)
 
 
+def send_artifact(path):
+    # byte ranges and If-None-Match are answered by send_file, the strong
+    # etag lets the browser revalidate instead of downloading again
+    response = send_file(os.path.abspath(path),
+                         conditional=True,
+                         etag=artifact_etag(path))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
 @fetch_routes.route('/get-tracks', methods=['GET'])
 @jwt_required()
 def get_recordings():
@@ -19,6 +33,9 @@ def get_recordings():
     session = Session.query.filter_by(name=user.selected_session,
                                       user=current_user).first()
     for track in session.tracks:
+        # tracks still converting are added by the upload once their job ends
+        if track.status != 'ready':
+            continue
         track_metadata = track.get_data()
         track_info.append(track_metadata)
     return jsonify({'message': 'success', 'info': track_info})
@@ -59,8 +76,9 @@ def get_audio_data(audio_name):
                                       user=current_user).first()
     track = Track.query.filter_by(filename=audio_name,
                                   session_id=session.id).first()
-    track_path, filename = os.path.split(track.path_44)
-    return send_from_directory('.' + track_path, filename)
+    if track is None or track.path_44 is None:
+        return jsonify({'message': 'audio not found'}), 404
+    return send_artifact(track.path_44)
 
 
 @fetch_routes.route('/get-waveform-data/<audio_name>', methods=['GET'])
@@ -70,9 +88,35 @@ def get_waveform_data(audio_name):
                                       user=current_user).first()
     track = Track.query.filter_by(filename=audio_name,
                                   session_id=session.id).first()
+    if track is None or track.path_44 is None:
+        return jsonify({'message': 'audio not found'}), 404
     path = track.path_44[:-4] + '.dat'
-    waveform_path, filename = os.path.split(path)
-    return send_from_directory('.' + waveform_path, filename)
+    # a coarser level of the waveform pyramid can be requested for overviews
+    samples_per_pixel = request.args.get('samplesPerPixel', type=int)
+    if samples_per_pixel:
+        path = select_level(path, samples_per_pixel)
+    return send_artifact(path)
+
+
+@fetch_routes.route('/get-waveform-peaks/<audio_name>', methods=['GET'])
+@jwt_required()
+def get_waveform_peaks(audio_name):
+    session = Session.query.filter_by(name=current_user.selected_session,
+                                      user=current_user).first()
+    track = Track.query.filter_by(filename=audio_name,
+                                  session_id=session.id).first()
+    if track is None or track.path_44 is None:
+        return jsonify({'message': 'audio not found'}), 404
+    start_time = request.args.get('start', default=0, type=float)
+    end_time = request.args.get('end', default=track.length_sec, type=float)
+    pixels_per_second = request.args.get('pps', default=100, type=float)
+    # nan and infinite values fail these checks as well
+    if not (0 < pixels_per_second < np.inf and
+            -np.inf < start_time < end_time < np.inf):
+        return jsonify({'message': 'invalid pps, start or end'}), 400
+    peaks = waveform_peaks(track.path_44[:-4] + '.dat', start_time, end_time,
+                           pixels_per_second)
+    return jsonify({'message': 'success', 'peaks': peaks})
 
 
 @fetch_routes.route('/download-measures', methods=['GET'])
@@ -168,9 +212,15 @@ def get_all_regions():
 def available_space():
     sessions = Session.query.filter_by(user=current_user).all()
     occupied = 0
+    # renditions shared through the blob store are counted once
+    counted_hashes = set()
     for session in sessions:
         for track in session.tracks:
-            occupied += track.disk_space
+            if track.content_hash:
+                if track.content_hash in counted_hashes:
+                    continue
+                counted_hashes.add(track.content_hash)
+            occupied += track.disk_space or 0
     current_user.occupied_space = round(occupied / (1024 * 1024), 2)
     db.session.commit()
     return jsonify({
@@ -2,6 +2,7 @@ from flask import Blueprint, jsonify, request
 from flask_jwt_extended import current_user, jwt_required
 
 from memovision import db
+from memovision.db_models import Session
 
 setting_routes = Blueprint('setting_routes', __name__)
 
@@ -10,6 +11,14 @@ setting_routes = Blueprint('setting_routes', __name__)
 @jwt_required()
 def set_precise_sync():
     req = request.json
+    if current_user.precise_sync != req['preciseSync']:
+        # paths of the other mode have to be recomputed by the next sync
+        session = Session.query.filter_by(name=current_user.selected_session,
+                                          user=current_user).first()
+        if session:
+            for track in session.tracks:
+                track.sync = False
+                track.sync_resolution = None
     current_user.precise_sync = req['preciseSync']
     db.session.commit()
     return jsonify({'message': 'success'})
\ No newline at end of file
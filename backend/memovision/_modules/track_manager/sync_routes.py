@@ -4,28 +4,21 @@ import numpy as np
 import scipy
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import current_user, jwt_required
-from librosa import load
-from madmom.audio import Signal
-from madmom.audio.chroma import DeepChromaProcessor
-from madmom.features.beats import DBNBeatTrackingProcessor
-from madmom.features.chords import DeepChromaChordRecognitionProcessor
 
 from memovision import db
-from memovision.db_models import DiffRegion, Session, Track
-from memovision.duplicate_finder.functions import (run_duplicate_finder,
-                                                   run_structure_checker,
-                                                   save_chromaImage)
-from memovision.helpers.functions import (PreProcessor,
-                                          compute_chroma_from_audio,
-                                          compute_dtw_path,
-                                          transfer_step_annotations)
+from memovision.app_config import Config
+from memovision.db_models import DiffRegion, Job, Session, Track
+from memovision.duplicate_finder.functions import (chroma_phash,
+                                                   run_duplicate_finder)
+from memovision.features.chroma import (SYNC_STAGES, apply_stages,
+                                        completed_stages, run_chroma_stages,
+                                        stage_args, stages_to_run)
+from memovision.jobs.queue import enqueue_job
+from memovision.sync import (check_target_structure, chroma_shifts,
+                             load_reference, switch_reference, sync_target,
+                             track_dir)
+from memovision.warping_path import load_time_map, warping_path_version
 
-# from tensorflow import keras
-
-
-# os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-# beat_tracking_model = keras.models.load_model(
-#     './models/simple_tcn_dp_skip_dilations_22_fps50.h5')
 sync_routes = Blueprint('sync_routes', __name__)
 
 
@@ -35,10 +28,16 @@ def select_reference():
     req = request.json
     session = Session.query.filter_by(name=current_user.selected_session,
                                       user=current_user).first()
-    for track in session.tracks:
-        track.reference = False
     track = Track.query.filter_by(filename=req['filename'],
                                   session_id=session.id).first()
+    old_ref = Track.query.filter_by(reference=True,
+                                    session_id=session.id).first()
+    if req['state'] and old_ref and old_ref is not track:
+        # paths to the previous reference are composed into paths to the
+        # new one, tracks without a path are synchronized again later
+        switch_reference(current_user.username, session.tracks, track)
+    for other in session.tracks:
+        other.reference = False
     track.reference = req['state']
     db.session.commit()
     return jsonify({'message': 'success'})
@@ -53,46 +52,56 @@ def sync_track(audio_name):
                                       user=current_user).first()
     target = Track.query.filter_by(filename=audio_name,
                                    session_id=session.id).first()
-    # if not target.sync:
-    target_chroma = np.load(
-        f'./user_uploads/{current_user.username}/{current_user.selected_session}/{target.filename}/features/chroma.npy'
-    )
     # reference track
     ref = Track.query.filter_by(reference=True, session_id=session.id).first()
-    ref_chroma = np.load(
-        f'./user_uploads/{current_user.username}/{current_user.selected_session}/{ref.filename}/features/chroma.npy'
-    )
-    # compute warping path
-    if req['precise']:
-        ref_act_func = np.load(
-            f'./user_uploads/{current_user.username}/{current_user.selected_session}/{ref.filename}/features/beatfun.npy'
-        )
-        target_act_func = np.load(
-            f'./user_uploads/{current_user.username}/{current_user.selected_session}/{target.filename}/features/beatfun.npy'
-        )
-        wp = compute_dtw_path(ref_chroma=ref_chroma,
-                              target_chroma=target_chroma,
-                              ref_onset=ref_act_func,
-                              target_onset=target_act_func,
-                              with_onsets=True)
-    else:
-        wp = compute_dtw_path(ref_chroma=ref_chroma,
-                              target_chroma=target_chroma)
-    with open(
-            f'./user_uploads/{current_user.username}/{current_user.selected_session}/{target.filename}/features/wp.npy',
-            'wb') as f:
-        np.save(f, wp)
+    try:
+        result = sync_target(load_reference(current_user.username, ref,
+                                            req['precise']),
+                             current_user.username,
+                             track_dir(current_user.username, target),
+                             target.content_hash,
+                             target.length_sec,
+                             req['precise'],
+                             chroma_shift=chroma_shifts(ref, [target])[0],
+                             memory_budget_mb=Config.SYNC_MEMORY_BUDGET_MB)
+    except MemoryError as e:
+        # the budget cannot hold the alignment of this pair of tracks
+        return jsonify({'message': str(e)}), 500
+    target.sync_resolution = result['resolution']
     target.sync = True
     db.session.commit()
-    # transfer step annotations
-    steps = transfer_step_annotations(10, ref.length_sec, target.length_sec,
-                                      wp)
-    np.savetxt(
-        f'./user_uploads/{current_user.username}/{current_user.selected_session}/{target.filename}/annotations/steps.txt',
-        steps,
-        fmt='%.5f')
-        
-    return jsonify({'message': 'success'})
+    return jsonify({
+        'message': 'success',
+        'peakMemoryMb': result['peak_memory_mb']
+    })
+
+
+@sync_routes.route('/sync-session', methods=['PUT'])
+@jwt_required()
+def sync_session():
+    req = request.json
+    session = Session.query.filter_by(name=current_user.selected_session,
+                                      user=current_user).first()
+    ref = Track.query.filter_by(reference=True, session_id=session.id).first()
+    if not ref:
+        return jsonify({'message': 'reference not selected'}), 400
+    tracks = Track.query.filter_by(session=session, sync=False,
+                                   status='ready').all()
+    files = [{
+        'track_id': track.id,
+        'filename': track.filename,
+        'status': 'queued'
+    } for track in tracks]
+    job = enqueue_job('sync-session',
+                      current_user,
+                      payload={
+                          'files': files,
+                          'ref_id': ref.id,
+                          'precise': bool(req['precise']),
+                          'preview': bool(req.get('preview', False))
+                      })
+    db.session.commit()
+    return jsonify({'message': 'success', 'jobId': job.id})
 
 
 @sync_routes.route('/transfer-measures', methods=['PUT'])
@@ -110,11 +119,11 @@ def transfer_measures():
         f'./user_uploads/{current_user.username}/{current_user.selected_session}/{ref_name}/annotations/gt_measures.npy'
     )
     # transfer measures
-    wp = np.load(
-        f'./user_uploads/{current_user.username}/{current_user.selected_session}/{target_name}/features/wp.npy'
+    ref_times, target_times = load_time_map(
+        f'./user_uploads/{current_user.username}/{current_user.selected_session}/{target_name}/features'
     )
     target_measures = list(
-        scipy.interpolate.interp1d(wp[0] / 50, wp[1] / 50,
+        scipy.interpolate.interp1d(ref_times, target_times,
                                    kind='linear')(ref_measures))
     target.tf_measures = True
     db.session.commit()
@@ -175,7 +184,23 @@ def chords():
     ref_track = Track.query.filter_by(reference=True,
                                       session_id=session.id).first()
     if ref_track:
-        ref_chords = f'./user_uploads/{current_user.username}/{current_user.selected_session}/{ref_track.filename}/features/chords.txt'
+        ref_chords = f'{track_dir(current_user.username, ref_track)}/features/chords.txt'
+        if not ref_track.chords and os.path.exists(ref_chords):
+            # computed before the stage flags existed
+            ref_track.chords = True
+            db.session.commit()
+        if not ref_track.chords:
+            # chords are only computed once somebody asks for them, in the
+            # background because the networks take minutes on long tracks
+            job = pending_stage_job(ref_track, ['chords'])
+            if job is None:
+                job = enqueue_stages(['chords'], [ref_track])
+                db.session.commit()
+            return jsonify({
+                'message': 'pending',
+                'chordsList': [],
+                'jobId': job.id
+            })
         chords_list = get_chords(ref_chords)
         return jsonify({'message': 'success', 'chordsList': chords_list})
     else:
@@ -185,22 +210,26 @@ def chords():
 @sync_routes.route('/find-duplicates', methods=['GET'])
 @jwt_required()
 def find_duplicates():
-    filenames = []
-    chroma_paths = []
-    img_paths = []
     session = Session.query.filter_by(name=current_user.selected_session,
                                       user=current_user).first()
+    tracks = []
     for track in session.tracks:
-        filenames.append(track.filename)
-        chroma_paths.append(
-            f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/chroma.npy'
-        )
-        img_paths.append(
-            f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/chroma.png'
-        )
-    duplicates = run_duplicate_finder(chromas=chroma_paths,
-                                      filenames=filenames,
-                                      img_paths=img_paths)
+        image = f'{track_dir(current_user.username, track)}/features/chroma.png'
+        # tracks imaged before the stage flags existed only have chroma
+        if not (track.chroma_image or
+                (track.chroma and os.path.exists(image))):
+            continue
+        # tracks imaged before the hash was stored are hashed once
+        if track.chroma_phash is None:
+            track.chroma_phash = chroma_phash(image)
+        track.chroma_image = True
+        tracks.append(track)
+    db.session.commit()
+    duplicates = run_duplicate_finder(
+        hashes=[track.chroma_phash for track in tracks],
+        filenames=[track.filename for track in tracks],
+        lengths=[track.length_sec for track in tracks],
+        tunings=[track.tuning_cents for track in tracks])
     return jsonify({'message': 'success', 'duplicates': duplicates})
 
 
@@ -209,91 +238,130 @@ def find_duplicates():
 def check_structure():
     session = Session.query.filter_by(name=current_user.selected_session,
                                       user=current_user).first()
-    ref_filename = Track.query.filter_by(
-        reference=True, session_id=session.id).first().filename
+    ref = Track.query.filter_by(reference=True, session_id=session.id).first()
     other_tracks = Track.query.filter_by(reference=False,
                                          session_id=session.id).order_by(
-                                             Track.filename.asc())
-    target_filenames = []
-    wps = []
+                                             Track.filename.asc()).all()
+    # only paths written since the last check are analysed again
+    checked = []
+    changed = []
     for track in other_tracks:
-        target_filenames.append(track.filename)
-        wps.append(
-            f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/wp.npy'
-        )
-    diff_recordings, diff_regions_list = run_structure_checker(
-        ref_filename, target_filenames, wps)
-    for diff_region in diff_regions_list:
-        track = Track.query.filter_by(filename=diff_region['filename'],
-                                      session_id=session.id).first()
-        track.num_bad_regions = len(diff_region['target'])
-        track.diff = True
-        for i in range(len(diff_region['target'])):
-            existing_reg = DiffRegion.query.filter_by(
-                start_time_ref=diff_region['ref'][i][0],
-                end_time_ref=diff_region['ref'][i][1],
-                start_time=diff_region['target'][i][0],
-                end_time=diff_region['target'][i][1],
-            ).first()
-            if not existing_reg:
-                db_diff_region = DiffRegion(
-                    start_time_ref=diff_region['ref'][i][0],
-                    end_time_ref=diff_region['ref'][i][1],
-                    start_time=diff_region['target'][i][0],
-                    end_time=diff_region['target'][i][1],
-                    track=track)
-                db.session.add(db_diff_region)
-        db.session.commit()
+        version = warping_path_version(
+            f'{track_dir(current_user.username, track)}/features')
+        if version is None:
+            continue
+        checked.append(track)
+        key = f'{ref.id}:{version}'
+        if track.structure_key != key:
+            track.structure_key = key
+            changed.append(track)
+    # a check takes milliseconds, so the changed paths are checked inline
+    # instead of forking the web worker into a pool
+    new_regions = []
+    for track in changed:
+        diff_region = check_target_structure(
+            ref.filename, track.filename,
+            f'{track_dir(current_user.username, track)}/features')
+        track.structure_regions = diff_region
+        track.diff = diff_region is not None
+        track.num_diff_regions = 0
+        if diff_region:
+            track.num_diff_regions = len(diff_region['target'])
+            for ref_region, target_region in zip(diff_region['ref'],
+                                                 diff_region['target']):
+                new_regions.append({
+                    'track_id': track.id,
+                    'start_time_ref': ref_region[0],
+                    'end_time_ref': ref_region[1],
+                    'start_time': target_region[0],
+                    'end_time': target_region[1]
+                })
+    # the regions of all re-analysed tracks are replaced in one bulk write
+    if changed:
+        DiffRegion.query.filter(
+            DiffRegion.track_id.in_([track.id for track in changed])).delete(
+                synchronize_session=False)
+        db.session.bulk_insert_mappings(DiffRegion, new_regions)
+    db.session.commit()
+    diff_regions_list = [
+        track.structure_regions for track in checked
+        if track.structure_regions
+    ]
     return jsonify({'message': 'success', 'diff_regions': diff_regions_list})
 
 
+def compute_track_stages(track, stages):
+    finished, updates, error = run_chroma_stages(
+        stages, completed_stages(track),
+        *stage_args(current_user.username, track))
+    apply_stages(track, finished, updates)
+    db.session.commit()
+    if error:
+        return jsonify({'message': error}), 500
+    return jsonify({'message': 'success'})
+
+
+def enqueue_stages(stages, tracks):
+    # one pooled job for every track missing some stage
+    files = [{
+        'track_id': track.id,
+        'filename': track.filename,
+        'status': 'queued'
+    } for track in tracks if stages_to_run(stages, completed_stages(track))]
+    return enqueue_job('chroma-session',
+                       current_user,
+                       payload={
+                           'files': files,
+                           'stages': stages
+                       })
+
+
+def pending_stage_job(track, stages):
+    # queued or running job already producing the stages for the track
+    jobs = Job.query.filter(Job.user_id == current_user.id,
+                            Job.kind == 'chroma-session',
+                            Job.status.in_(['queued', 'running'])).all()
+    for job in jobs:
+        if job.payload['stages'] == stages and any(
+                f['track_id'] == track.id for f in job.payload['files']):
+            return job
+    return None
+
+
+def queue_session_stages(stages):
+    session = Session.query.filter_by(name=current_user.selected_session,
+                                      user=current_user).first()
+    tracks = Track.query.filter_by(session=session, status='ready').all()
+    job = enqueue_stages(stages, tracks)
+    db.session.commit()
+    return jsonify({'message': 'success', 'jobId': job.id})
+
+
 @sync_routes.route('/compute-chroma/<audio_name>', methods=['PUT'])
 @jwt_required()
 def compute_chroma(audio_name):
     session = Session.query.filter_by(name=current_user.selected_session,
                                       user=current_user).first()
     track = Track.query.filter_by(filename=audio_name, session=session).first()
-    if not track.chroma:
-        chroma_path = f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/chroma.npy'
-        audio, _ = load(track.path_22, mono=True)
-        chroma, tuning_offset = compute_chroma_from_audio(audio)
-        with open(chroma_path, 'wb') as f:
-            np.save(f, chroma)
-        save_chromaImage(
-            chroma_path,
-            f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/chroma.png'
-        )
-        chroma_proc = DeepChromaProcessor()
-        audio_44, _ = load(track.path_44, mono=True, sr=44100)
-        deep_chroma = chroma_proc(audio_44)
-        chords_proc = DeepChromaChordRecognitionProcessor()
-        chords_path = f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/chords.txt'
-        chords = chords_proc(deep_chroma)
-        with open(chords_path, 'wb') as f:
-            np.savetxt(f, chords, fmt='%s')
-        track.chroma = True
-        db.session.commit()
-    return jsonify({'message': 'success'})
+    return compute_track_stages(track, SYNC_STAGES)
+
+
+@sync_routes.route('/compute-chroma-session', methods=['PUT'])
+@jwt_required()
+def compute_chroma_session():
+    return queue_session_stages(SYNC_STAGES)
 
 
-# @sync_routes.route('/compute-act-func/<audio_name>', methods=['PUT'])
-# @jwt_required()
-# def compute_act_func(audio_name):
-#     session = Session.query.filter_by(name=current_user.selected_session,
-#                                       user=current_user).first()
-#     track = Track.query.filter_by(filename=audio_name, session=session).first()
-#     if not track.act_func:
-#         act_func_path = f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/beatfun.npy'
-#         audio_data, sr = load(track.path_22, mono=True)
-#         audio_signal = Signal(audio_data, sr)
-#         preprocessed = PreProcessor()(audio_signal)
-#         act_fun = beat_tracking_model(
-#             preprocessed[np.newaxis, ..., np.newaxis]).numpy().flatten('C')
-#         np.save(act_func_path, act_fun)
-#         track.act_func = True
-#         dbn_proc = DBNBeatTrackingProcessor(fps=50)
-#         beats = dbn_proc(act_fun)
-#         beats_path = f'./user_uploads/{current_user.username}/{current_user.selected_session}/{track.filename}/features/beats.txt'
-#         np.savetxt(beats_path, beats, fmt='%.10f')
-#         db.session.commit()
-#     return jsonify({'message': 'success'})
+@sync_routes.route('/compute-act-func/<audio_name>', methods=['PUT'])
+@jwt_required()
+def compute_act_func(audio_name):
+    session = Session.query.filter_by(name=current_user.selected_session,
+                                      user=current_user).first()
+    track = Track.query.filter_by(filename=audio_name, session=session).first()
+    return compute_track_stages(track, ['act_func'])
+
+
+@sync_routes.route('/compute-act-func-session', methods=['PUT'])
+@jwt_required()
+def compute_act_func_session():
+    return queue_session_stages(['act_func'])
@@ -3,6 +3,7 @@ import shutil
 
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import current_user, jwt_required
+from memovision.blob_store import release_blob
 from memovision.db_models import Session, Track
 
 from memovision import db
@@ -32,11 +33,13 @@ def delete_from_db():
     filename = request.json['data']
     track = Track.query.filter_by(filename=filename,
                                   session_id=session.id).first()
+    content_hash = track.content_hash
     db.session.delete(track)
     db.session.commit()
     filepath = f'./user_uploads/{current_user.username}/{current_user.selected_session}/{filename}'
     if os.path.exists(filepath):
         shutil.rmtree(filepath)
+    release_blob(current_user, content_hash)
     return jsonify({'message': f'successfully deleted track: {filename}'})
 
 
@@ -46,6 +49,7 @@ def delete_all_from_db():
     session = Session.query.filter_by(name=current_user.selected_session,
                                       user=current_user).first()
     tracks = session.tracks
+    content_hashes = set(track.content_hash for track in tracks)
     for track in tracks:
         db.session.delete(track)
     db.session.commit()
@@ -58,4 +62,6 @@ def delete_all_from_db():
     os.mkdir(
         f'./user_uploads/{current_user.username}/{current_user.selected_session}/relevance'
     )
+    for content_hash in content_hashes:
+        release_blob(current_user, content_hash)
     return jsonify({'message': 'success'})
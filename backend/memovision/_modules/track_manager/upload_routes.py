@@ -1,20 +1,27 @@
+import hashlib
 import os
-import subprocess
+import uuid
+import zipfile
+from datetime import datetime, timedelta
 
 import numpy as np
 import pandas as pd
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import current_user, jwt_required
-from librosa import load
-from memovision.db_models import Session, Track
-from memovision.helpers.functions import (convert_audio, estimate_tuning,
-                                          strip_extension)
+from memovision.app_config import Config
+from memovision.blob_store import save_with_hash
+from memovision.db_models import ChunkedUpload, Session, Track
+from memovision.helpers.functions import strip_extension
+from memovision.jobs.queue import enqueue_job
 from werkzeug.utils import secure_filename
 
 from memovision import db
 
 upload_routes = Blueprint('upload_routes', __name__)
 
+CHUNK_BLOCK_SIZE = 1024 * 1024
+upload_hashers = {}
+
 
 @upload_routes.route('/pre-upload-check', methods=['POST'])
 @jwt_required()
@@ -32,6 +39,31 @@ def pre_upload_check():
     return jsonify({'message': 'success', 'exists': track_exists})
 
 
+def create_track_folders(user, filename):
+    # create separate folder for audio file that is being uplodaded, the
+    # folders of an unfinished upload of the same name are reused
+    track_folder = f'./user_uploads/{user.username}/{user.selected_session}/{filename}'
+    # create annotations folder
+    os.makedirs(f'{track_folder}/annotations', exist_ok=True)
+    # create features folder
+    os.makedirs(f'{track_folder}/features', exist_ok=True)
+
+
+def queue_ingest(user, session, filename, filepath, content_hash=None):
+    # conversion runs in a worker process, see memovision.jobs.tasks
+    track = Track(filename=filename,
+                  status='converting',
+                  disk_space=0,
+                  content_hash=content_hash,
+                  session_id=session.id)
+    db.session.add(track)
+    job = enqueue_job('ingest',
+                      user,
+                      track=track,
+                      payload={'filepath': filepath})
+    return track, job
+
+
 @upload_routes.route('/upload-audio-file', methods=['POST'])
 @jwt_required()
 def upload_audio_file():
@@ -42,53 +74,264 @@ def upload_audio_file():
     session = Session.query.filter_by(name=current_user.selected_session,
                                       user=current_user).first()
     if file:
-        # create separate folder for audio file that is being uplodaded
-        os.mkdir(
-            f'./user_uploads/{user.username}/{user.selected_session}/{filename}'
-        )
-        # create annotations folder
-        os.mkdir(
-            f'./user_uploads/{user.username}/{user.selected_session}/{filename}/annotations'
-        )
-        # create features folder
-        os.mkdir(
-            f'./user_uploads/{user.username}/{user.selected_session}/{filename}/features'
-        )
+        create_track_folders(user, filename)
         # create filepath
         filepath = f'./user_uploads/{user.username}/{user.selected_session}/{filename}/{filename_with_ext}'
-        file.save(filepath)
-        # convert to a sr of 22050 Hz via ffmpeg
-        path_44 = convert_audio(filepath, sr=44100, mono=False)
-        path_22 = convert_audio(filepath, sr=22050, mono=False)
-        audiowaveform_path = path_44[:-4] + '.dat'
-        audiowaveform_cmd = f'audiowaveform -i {path_44} -o {audiowaveform_path} -b 8 -q -z 32'
-        subprocess.call(audiowaveform_cmd, shell=True)
-        disk_space = (os.path.getsize(path_44) + os.path.getsize(path_22))
-        # compute length in seconds
-        audio, sr = load(path_22, sr=22050, mono=True)
-        length_sec = len(audio) / sr
-        tuning_offset_cents = estimate_tuning(audio, Fs=sr)
-        tuning_offset_hz = round(440 * pow(2, tuning_offset_cents / 1200), 1)
-        # remove original file
-        os.remove(filepath)
-        # add track to the database
-        track = Track(filename=filename,
-                      length_sec=length_sec,
-                      path_44=path_44,
-                      path_22=path_22,
-                      disk_space=disk_space,
-                      tuning_offset=tuning_offset_hz,
-                      session_id=session.id)
-        db.session.add(track)
+        content_hash = save_with_hash(file.stream, filepath)
+        track, job = queue_ingest(user,
+                                  session,
+                                  filename,
+                                  filepath,
+                                  content_hash=content_hash)
         db.session.commit()
         return jsonify({
             'message': 'file succesfully uploaded',
-            'obj': track.get_data()
+            'obj': track.get_data(),
+            'jobId': job.id
         })
     else:
         return jsonify({'message': 'file could not be uploaded'})
 
 
+def archive_members(archive):
+    # yield (filename, file object) for every file stored in a zip archive
+    with zipfile.ZipFile(archive) as zf:
+        for member in zf.infolist():
+            basename = os.path.basename(member.filename)
+            if member.is_dir() or member.filename.startswith(
+                    '__MACOSX') or basename.startswith('.'):
+                continue
+            with zf.open(member) as f:
+                yield basename, f
+
+
+@upload_routes.route('/upload-audio-files', methods=['POST'])
+@jwt_required()
+def upload_audio_files():
+    user = current_user
+    session = Session.query.filter_by(name=current_user.selected_session,
+                                      user=current_user).first()
+    uploads = [(file.filename, file.stream)
+               for file in request.files.getlist('files')]
+    if 'archive' in request.files:
+        uploads = archive_members(request.files['archive'].stream)
+    files = []
+    skipped = []
+    tracks = []
+    for original_name, file in uploads:
+        filename_with_ext = secure_filename(original_name)
+        filename = strip_extension(filename_with_ext)
+        exists = Track.query.filter_by(filename=filename,
+                                       session_id=session.id).first()
+        if not filename or exists or filename in [f['filename'] for f in files]:
+            skipped.append(original_name)
+            continue
+        create_track_folders(user, filename)
+        filepath = f'./user_uploads/{user.username}/{user.selected_session}/{filename}/{filename_with_ext}'
+        content_hash = save_with_hash(file, filepath)
+        track = Track(filename=filename,
+                      status='converting',
+                      disk_space=0,
+                      content_hash=content_hash,
+                      session_id=session.id)
+        db.session.add(track)
+        tracks.append(track)
+        files.append({'filename': filename, 'filepath': filepath})
+    if not files:
+        return jsonify({
+            'message': 'files could not be uploaded',
+            'skipped': skipped
+        })
+    # flush to get the track ids for the job payload
+    db.session.flush()
+    for f, track in zip(files, tracks):
+        f['track_id'] = track.id
+        f['status'] = 'converting'
+    job = enqueue_job('ingest-batch', user, payload={'files': files})
+    db.session.commit()
+    return jsonify({
+        'message': 'files succesfully uploaded',
+        'objs': [track.get_data() for track in tracks],
+        'skipped': skipped,
+        'jobId': job.id
+    })
+
+
+def upload_folder(upload):
+    return f'./user_uploads/{upload.session.user.username}/{upload.session.name}/{upload.filename}'
+
+
+def upload_path(upload):
+    return f'{upload_folder(upload)}/{upload.filename_with_ext}'
+
+
+def part_path(upload):
+    return upload_path(upload) + '.part'
+
+
+def get_hasher(upload):
+    # keep the running hash of every upload handled by this process, after
+    # a restart or on another worker it is rebuilt from the part file
+    cached = upload_hashers.get(upload.id)
+    if cached and cached[0] == upload.offset:
+        return cached[1].copy()
+    hasher = hashlib.sha256()
+    remaining = upload.offset
+    with open(part_path(upload), 'rb') as f:
+        while remaining > 0:
+            block = f.read(min(CHUNK_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            hasher.update(block)
+            remaining -= len(block)
+    return hasher
+
+
+def remove_empty_folders(path):
+    # the folders created for an upload are removed unless a file was added
+    for dirpath, _, _ in os.walk(path, topdown=False):
+        try:
+            os.rmdir(dirpath)
+        except OSError:
+            pass
+
+
+def expire_uploads(expire_after=Config.UPLOAD_EXPIRE_AFTER):
+    # uploads abandoned by their client are dropped with their part file,
+    # rows locked by a chunk being written are left alone
+    deadline = datetime.now() - timedelta(seconds=expire_after)
+    expired = ChunkedUpload.query.filter(
+        ChunkedUpload.created_at < deadline).with_for_update(
+            skip_locked=True).all()
+    for upload in expired:
+        upload_hashers.pop(upload.id, None)
+        if os.path.exists(part_path(upload)):
+            os.remove(part_path(upload))
+        remove_empty_folders(upload_folder(upload))
+        db.session.delete(upload)
+    db.session.commit()
+
+
+@upload_routes.route('/upload-init', methods=['POST'])
+@jwt_required()
+def upload_init():
+    req = request.json
+    user = current_user
+    filename_with_ext = secure_filename(req['filename'])
+    filename = strip_extension(filename_with_ext)
+    expire_uploads()
+    session = Session.query.filter_by(name=current_user.selected_session,
+                                      user=current_user).first()
+    # resume an interrupted upload of the same file
+    upload = ChunkedUpload.query.filter_by(
+        session_id=session.id,
+        filename_with_ext=filename_with_ext).with_for_update().first()
+    if upload and upload.total_size == req['size'] and (
+            upload.fingerprint == req.get('fingerprint')):
+        return jsonify({'message': 'success', 'upload': upload.get_data()})
+    if upload:
+        # another file with the same name was not finished, its data is
+        # dropped and its folders are reused
+        upload_hashers.pop(upload.id, None)
+        db.session.delete(upload)
+    else:
+        if Track.query.filter_by(filename=filename,
+                                 session_id=session.id).first():
+            return jsonify({'message': 'track already exists'}), 409
+        create_track_folders(user, filename)
+    upload = ChunkedUpload(id=uuid.uuid4().hex,
+                           user_id=user.id,
+                           session=session,
+                           filename=filename,
+                           filename_with_ext=filename_with_ext,
+                           total_size=req['size'],
+                           fingerprint=req.get('fingerprint'),
+                           offset=0,
+                           created_at=datetime.now())
+    open(part_path(upload), 'wb').close()
+    db.session.add(upload)
+    db.session.commit()
+    return jsonify({'message': 'success', 'upload': upload.get_data()})
+
+
+@upload_routes.route('/upload-chunk/<upload_id>', methods=['GET', 'PUT'])
+@jwt_required()
+def upload_chunk(upload_id):
+    query = ChunkedUpload.query.filter_by(id=upload_id,
+                                          user_id=current_user.id)
+    if request.method == 'PUT':
+        # the row stays locked until the chunk is committed, a retry of the
+        # same chunk waits here and is then rejected by the offset check
+        query = query.with_for_update()
+    upload = query.first()
+    if not upload:
+        return jsonify({'message': 'upload not found'}), 404
+    if request.method == 'GET':
+        return jsonify({'message': 'success', 'upload': upload.get_data()})
+    offset = request.args.get('offset', type=int)
+    if offset != upload.offset:
+        # the client resumes from the last acknowledged offset
+        return jsonify({
+            'message': 'offset mismatch',
+            'upload': upload.get_data()
+        }), 409
+    hasher = get_hasher(upload)
+    written = 0
+    with open(part_path(upload), 'r+b') as f:
+        # drop any bytes of a chunk that was not acknowledged
+        f.seek(offset)
+        f.truncate()
+        while True:
+            block = request.stream.read(CHUNK_BLOCK_SIZE)
+            if not block:
+                break
+            if offset + written + len(block) > upload.total_size:
+                return jsonify({'message': 'chunk exceeds file size'}), 400
+            f.write(block)
+            hasher.update(block)
+            written += len(block)
+        f.flush()
+        os.fsync(f.fileno())
+    upload.offset = offset + written
+    db.session.commit()
+    upload_hashers[upload.id] = (upload.offset, hasher)
+    return jsonify({'message': 'success', 'upload': upload.get_data()})
+
+
+@upload_routes.route('/upload-finalize/<upload_id>', methods=['POST'])
+@jwt_required()
+def upload_finalize(upload_id):
+    user = current_user
+    # a second finalize of the same upload waits here and then finds the
+    # row deleted
+    upload = ChunkedUpload.query.filter_by(
+        id=upload_id, user_id=user.id).with_for_update().first()
+    if not upload:
+        return jsonify({'message': 'upload not found'}), 404
+    if upload.offset != upload.total_size:
+        return jsonify({
+            'message': 'upload incomplete',
+            'upload': upload.get_data()
+        }), 409
+    content_hash = get_hasher(upload).hexdigest()
+    upload_hashers.pop(upload.id, None)
+    filepath = upload_path(upload)
+    os.replace(part_path(upload), filepath)
+    track, job = queue_ingest(user,
+                              upload.session,
+                              upload.filename,
+                              filepath,
+                              content_hash=content_hash)
+    db.session.delete(upload)
+    db.session.commit()
+    return jsonify({
+        'message': 'file succesfully uploaded',
+        'obj': track.get_data(),
+        'jobId': job.id,
+        'contentHash': content_hash
+    })
+
+
 @upload_routes.route('/upload-measures', methods=['POST'])
 @jwt_required()
 def upload_measures():
@@ -9,6 +9,7 @@ from flask_jwt_extended import current_user, jwt_required
 
 from memovision import bcrypt, db
 from memovision.db_models import User
+from memovision.model_registry import model_stats
 
 admin = Blueprint('admin', __name__)
 
@@ -90,6 +91,15 @@ def get_users():
     }), 200
 
 
+@admin.route('/admin/models', methods=['GET'])
+@jwt_required()
+def get_models():
+    if not admin_required():
+        return jsonify({'message': 'forbidden'}), 403
+
+    return jsonify({'models': model_stats()}), 200
+
+
 @admin.route('/admin/users/<int:user_id>', methods=['GET'])
 @jwt_required()
 def get_user(user_id):
@@ -20,3 +20,25 @@ class Config:
     JWT_TOKEN_LOCATION = ["cookies"]
     JWT_COOKIE_SECURE = config.getboolean("jwt", "cookie_secure")
     JWT_COOKIE_CSRF_PROTECT = config.getboolean("jwt", "csrf_protect")
+
+    JOB_WORKERS = config.getint("jobs", "workers", fallback=2)
+    JOB_POLL_INTERVAL = config.getfloat("jobs", "poll_interval", fallback=1.0)
+    JOB_POOL_SIZE = config.getint("jobs", "pool_size", fallback=4)
+    JOB_HEARTBEAT_INTERVAL = config.getfloat("jobs",
+                                             "heartbeat_interval",
+                                             fallback=10.0)
+    JOB_STALE_AFTER = config.getfloat("jobs", "stale_after", fallback=120.0)
+
+    UPLOAD_EXPIRE_AFTER = config.getfloat("uploads",
+                                          "expire_after",
+                                          fallback=86400.0)
+
+    SYNC_MEMORY_BUDGET_MB = config.getfloat("sync",
+                                            "memory_budget_mb",
+                                            fallback=6144)
+
+    PRELOAD_MODELS = [
+        name.strip()
+        for name in config.get("models", "preload", fallback="").split(",")
+        if name.strip()
+    ]
@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import soundfile
+from librosa import resample, to_mono
+
+# playback renditions are streamed to the browser, the ogg muxer picks the
+# codec available in the ffmpeg build, analysis renditions are lossless flac
+# which soundfile decodes and seeks in blocks
+PLAYBACK_CODEC = None
+PLAYBACK_EXT = 'ogg'
+ANALYSIS_CODEC = 'flac'
+ANALYSIS_EXT = 'flac'
+
+
+def audio_info(path):
+    info = soundfile.info(path)
+    return {
+        'sr': info.samplerate,
+        'channels': info.channels,
+        'num_samples': info.frames
+    }
+
+
+def load_audio(path, sr=None, mono=True, start=0, stop=None):
+    """Decode a stored rendition.
+            Parameters
+            ----------
+            path : str
+                Path to the rendition
+
+            sr : int or None
+                Target sample rate, None keeps the rate stored in the header
+
+            mono : bool
+                Downmix to a single channel
+
+            start, stop : int
+                Range of samples to decode (at the stored sample rate)
+
+            Returns
+            -------
+            audio : np.ndarray
+                Audio samples, shape (n,) if mono else (channels, n)
+            sr : int
+                Sample rate of the returned audio
+            """
+    audio, sr_native = soundfile.read(path,
+                                      start=start,
+                                      stop=stop,
+                                      dtype='float32',
+                                      always_2d=True)
+    audio = audio.T
+    if mono:
+        audio = to_mono(audio)
+    elif audio.shape[0] == 1:
+        audio = audio[0]
+    if sr is not None and sr != sr_native:
+        audio = resample(audio, orig_sr=sr_native, target_sr=sr)
+    else:
+        sr = sr_native
+    return np.ascontiguousarray(audio), sr
+
+
+def renditions_disk_space(*paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import shutil
+
+from memovision.audio import ANALYSIS_EXT, PLAYBACK_EXT
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# canonical names of the renditions inside a blob folder
+RENDITIONS = {
+    'path_44': f'playback.{PLAYBACK_EXT}',
+    'path_22': f'analysis.{ANALYSIS_EXT}',
+    'waveform': 'waveform.dat'
+}
+
+
+def blob_dir(username, content_hash):
+    return f'./user_uploads/{username}/.blobs/{content_hash}'
+
+
+def save_with_hash(stream, filepath):
+    # copy an uploaded stream to disk and hash it on the way
+    hasher = hashlib.sha256()
+    with open(filepath, 'wb') as f:
+        while True:
+            block = stream.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+            f.write(block)
+    return hasher.hexdigest()
+
+
+def file_hash(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def artifact_etag(path):
+    # the content hash is kept in a sidecar file and recomputed only when
+    # the artifact changes on disk
+    stat = os.stat(path)
+    version = f'{stat.st_mtime_ns} {stat.st_size}'
+    sidecar = path + '.sha256'
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            cached_version, _, cached_hash = f.read().rpartition(' ')
+        if cached_version == version:
+            return cached_hash
+    content_hash = file_hash(path)
+    with open(sidecar, 'w') as f:
+        f.write(f'{version} {content_hash}')
+    return content_hash
+
+
+def link_file(src, dst):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # different filesystem or no hardlink support
+        shutil.copyfile(src, dst)
+
+
+def unshare(path):
+    # writers call this before rewriting an artifact in place, otherwise
+    # every hardlinked copy of the file would change as well
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        os.remove(path)
+
+
+def store_renditions(username, content_hash, data, waveform_path):
+    blob = blob_dir(username, content_hash)
+    os.makedirs(blob, exist_ok=True)
+    link_file(data['path_44'], f'{blob}/{RENDITIONS["path_44"]}')
+    link_file(data['path_22'], f'{blob}/{RENDITIONS["path_22"]}')
+    link_file(waveform_path, f'{blob}/{RENDITIONS["waveform"]}')
+    # meta.json is written last and marks the blob as complete
+    with open(f'{blob}/meta.json', 'w') as f:
+        json.dump(data, f)
+
+
+def restore_renditions(username, content_hash, track_dir, filename):
+    blob = blob_dir(username, content_hash)
+    if not os.path.exists(f'{blob}/meta.json'):
+        return None
+    with open(f'{blob}/meta.json') as f:
+        data = json.load(f)
+    data['path_44'] = f'{track_dir}/{filename}_44100.{PLAYBACK_EXT}'
+    data['path_22'] = f'{track_dir}/{filename}_22050.{ANALYSIS_EXT}'
+    link_file(f'{blob}/{RENDITIONS["path_44"]}', data['path_44'])
+    link_file(f'{blob}/{RENDITIONS["path_22"]}', data['path_22'])
+    link_file(f'{blob}/{RENDITIONS["waveform"]}', data['path_44'][:-4] + '.dat')
+    return data
+
+
+def artifact_key(name, **params):
+    # parameter-identical artifacts of the same audio share one file
+    params_hash = hashlib.sha1(
+        json.dumps(params, sort_keys=True).encode()).hexdigest()[:12]
+    return f'{name}-{params_hash}'
+
+
+def fetch_artifact(username, content_hash, key, dst):
+    if not content_hash:
+        return False
+    src = f'{blob_dir(username, content_hash)}/artifacts/{key}'
+    if not os.path.exists(src):
+        return False
+    link_file(src, dst)
+    return True
+
+
+def store_artifact(username, content_hash, key, src):
+    if not content_hash or not os.path.exists(src):
+        return
+    artifacts_dir = f'{blob_dir(username, content_hash)}/artifacts'
+    os.makedirs(artifacts_dir, exist_ok=True)
+    link_file(src, f'{artifacts_dir}/{key}')
+
+
+def release_blob(user, content_hash):
+    # drop the blob once no track of the user refers to it
+    from memovision.db_models import Session, Track
+    if not content_hash:
+        return
+    in_use = Track.query.join(Session).filter(
+        Session.user_id == user.id,
+        Track.content_hash == content_hash).first()
+    if not in_use:
+        shutil.rmtree(blob_dir(user.username, content_hash),
+                      ignore_errors=True)
@@ -48,16 +48,38 @@ class Track(db.Model):
     path_44 = db.Column(db.String, unique=True)
     path_22 = db.Column(db.String, unique=True)
     tuning_offset = db.Column(db.Float)
+    # estimated once at upload, reused by the chroma extraction
+    tuning_cents = db.Column(db.Float)
     year = db.Column(db.String)
     performer = db.Column(db.String)
     reference = db.Column(db.Boolean, default=False)
     chroma = db.Column(db.Boolean, default=False)
+    # further stages of the chroma pipeline, see memovision.features.chroma
+    pitch = db.Column(db.Boolean, default=False)
+    chroma_image = db.Column(db.Boolean, default=False)
+    deep_chroma = db.Column(db.Boolean, default=False)
+    chords = db.Column(db.Boolean, default=False)
+    cens = db.Column(db.Boolean, default=False)
+    # normalized 12-d sum of the cens features, used for the chroma shift
+    chroma_profile = db.Column(db.JSON)
+    # hex perceptual hash of chroma.png, used by the duplicate finder
+    chroma_phash = db.Column(db.String)
     act_func = db.Column(db.Boolean, default=False)
     sync = db.Column(db.Boolean, default=False)
+    # feature rate of the stored warping path, below 50 for preview paths
+    sync_resolution = db.Column(db.Float)
     diff = db.Column(db.Boolean, default=False)
     gt_measures = db.Column(db.Boolean, default=False)
     tf_measures = db.Column(db.Boolean, default=False)
     num_diff_regions = db.Column(db.Integer)
+    # reference and warping path version the structure was last checked
+    # for, and the regions found then (None if the structure matched)
+    structure_key = db.Column(db.String)
+    structure_regions = db.Column(db.JSON)
+    # converting or ready, tracks whose conversion failed are deleted
+    status = db.Column(db.String, default='ready')
+    # sha256 of the uploaded file, shared renditions live in the blob store
+    content_hash = db.Column(db.String, index=True)
     regions = db.relationship('TrackRegion',
                               backref='track',
                               passive_deletes=True)
@@ -81,11 +103,13 @@ class Track(db.Model):
             'year': self.year,
             'performer': self.performer,
             'sync': self.sync,
+            'sync_resolution': self.sync_resolution,
             'reference': self.reference,
             'gt_measures': self.gt_measures,
             'tf_measures': self.tf_measures,
             'diff': self.diff,
-            'num_bad_regions': self.num_diff_regions
+            'num_bad_regions': self.num_diff_regions,
+            'status': self.status
         }
         return data
 
@@ -133,3 +157,71 @@ class TrackLabel(db.Model):
     label_name = db.Column(db.String)
     label_type = db.Column(db.String)
     label = db.Column(db.Boolean)
+
+
+class ChunkedUpload(db.Model):
+    id = db.Column(db.String, primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('user.id', ondelete='CASCADE'))
+    session_id = db.Column(db.Integer,
+                           db.ForeignKey('session.id', ondelete='CASCADE'))
+    filename = db.Column(db.String)
+    filename_with_ext = db.Column(db.String)
+    total_size = db.Column(db.BigInteger)
+    # computed by the client from the file, an upload is only resumed for
+    # the same file and not just for one with the same name and size
+    fingerprint = db.Column(db.String)
+    # number of bytes acknowledged so far
+    offset = db.Column(db.BigInteger, default=0)
+    created_at = db.Column(db.DateTime)
+    session = db.relationship('Session')
+
+    def get_data(self):
+        data = {
+            'uploadId': self.id,
+            'filename': self.filename,
+            'totalSize': self.total_size,
+            'offset': self.offset
+        }
+        return data
+
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer,
+                        db.ForeignKey('user.id', ondelete='CASCADE'))
+    track_id = db.Column(db.Integer,
+                         db.ForeignKey('track.id', ondelete='SET NULL'))
+    kind = db.Column(db.String, nullable=False)
+    # queued, running, done or failed
+    status = db.Column(db.String, default='queued', index=True)
+    progress = db.Column(db.Float, default=0)
+    payload = db.Column(db.JSON, default=dict)
+    error = db.Column(db.String)
+    created_at = db.Column(db.DateTime)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    # refreshed by the worker while the job runs, see jobs.queue
+    heartbeat_at = db.Column(db.DateTime)
+    track = db.relationship('Track')
+    user = db.relationship('User')
+
+    def get_data(self):
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'track': self.track.get_data() if self.track else None,
+            'files': [{
+                'filename': f['filename'],
+                'status': f['status'],
+                'peak_memory_mb': f.get('peak_memory_mb'),
+                'error': f.get('error')
+            } for f in (self.payload or {}).get('files', [])]
+        }
+        return data
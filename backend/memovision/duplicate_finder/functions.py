@@ -1,6 +1,5 @@
 ﻿import numpy as np
 import imagehash
-import matplotlib.pyplot as plt
 from PIL import Image
 
 
@@ -13,9 +12,15 @@ def save_chromaImage(chroma_path, output_image):
     im.save(output_image)
 
 
-def find_nearest(array, value):
-    index = np.abs(array - value).argmin()
-    return array.flat[index]
+def nearest_positions(values, first_positions, points):
+    # position of the first path entry holding the value nearest to each
+    # point, ties go to the smaller value like an argmin over the path
+    if len(values) == 1:
+        return np.zeros(len(points), dtype=int)
+    right = np.clip(np.searchsorted(values, points), 1, len(values) - 1)
+    left = right - 1
+    take_left = np.abs(points - values[left]) <= np.abs(values[right] - points)
+    return first_positions[np.where(take_left, left, right)]
 
 
 def compute_slope(x1, y1, x2, y2):
@@ -27,8 +32,11 @@ def verify_path_slope(warping_path, segmentdivider, pair_names, diff_max=3, area
     pathx = np.array(warping_path[0, :])
     pathy = np.array(warping_path[1, :])
 
-    pathxminval = min(pathx)
-    pathxmaxval = max(pathx)
+    # warping paths are monotone, so the distinct x values are sorted
+    values, first_positions = np.unique(pathx, return_index=True)
+
+    pathxminval = values[0]
+    pathxmaxval = values[-1]
     pathxvalrange = pathxmaxval - pathxminval
 
     modulo = pathxvalrange % segmentdivider
@@ -36,22 +44,12 @@ def verify_path_slope(warping_path, segmentdivider, pair_names, diff_max=3, area
 
     refpoint1xval = int(pathxminval + (pathxvalrange / segmentdivider))
     refpoint2xval = int(pathxminval + (pathxvalrange / segmentdivider) * (segmentdivider - 1))
-    refpoint1xpos = int(np.argwhere(pathx == refpoint1xval)[0])
-    refpoint2xpos = int(np.argwhere(pathx == refpoint2xval)[0])
+    refpoint1xpos = int(np.flatnonzero(pathx == refpoint1xval)[0])
+    refpoint2xpos = int(np.flatnonzero(pathx == refpoint2xval)[0])
 
     if debug:
         print(f'Point x start: {refpoint1xval} and x end: {refpoint2xval}')
 
-    refpointsx = np.array([pathx[refpoint1xpos], pathx[refpoint2xpos]])
-    refpointsy = np.array([pathy[refpoint1xpos], pathy[refpoint2xpos]])
-
-    # Line approximation
-    coefficients = np.polyfit(refpointsx, refpointsy, 1)
-    polynomial = np.poly1d(coefficients)
-
-    linex = np.arange(start=0, stop=len(pathx), step=1)
-    liney = polynomial(linex)
-
     testpointsnum = int((refpoint2xval - refpoint1xval) / 100)  # one point in cca 3 seconds cuz 50 fps
     if debug:
         print(f'No of testpoints: {testpointsnum}')
@@ -66,90 +64,32 @@ def verify_path_slope(warping_path, segmentdivider, pair_names, diff_max=3, area
         testpointsnum = refpointsvaldiff - 1
     testpointstep = refpointsvaldiff / testpointsnum  # step size
 
-    # Testing of points
+    # Testing of points, every slope is taken between two neighbouring points
     testpointxshift = testpointstep / 2
-    list_of_x_points = []
-    list_of_y_points = []
-    list_of_slopes = []
-    wrong_x_points = []
-    wrong_y_points = []
-
-    if plotting:
-        plt.figure()
-
-    is_same = True
-    for i in range(0, testpointsnum, 1):  # cycle iterating across individual testing points
-        if list_of_x_points:
-            previous_x_testpoint = list_of_x_points[-1]
-            previous_y_testpoint = list_of_y_points[-1]
-
-            testpointxval = refpoint1xval + i * testpointstep + testpointxshift  # finding the value for testing
-            testpointnearestxval = find_nearest(pathx, testpointxval)  # finding the nearest value to the test value
-            testpointxpos = np.argwhere(pathx == testpointnearestxval)[0]
-            pathval = float(pathy[testpointxpos])  # finding the value that matches the index found in the previous step
-            current_slope = compute_slope(previous_x_testpoint, previous_y_testpoint, testpointnearestxval, pathval)
-            list_of_slopes.append(current_slope)
-            list_of_x_points.append(testpointnearestxval)
-            list_of_y_points.append(pathval)
-
-            if plotting:
-                if abs(current_slope - ref_slope) > diff_max or current_slope <= diff_min:
-                    plt.plot(testpointnearestxval, pathval, '+', markersize=12, color='red')
-                else:
-                    plt.plot(testpointnearestxval, pathval, '+', markersize=12, color='green')
-
-            if abs(current_slope - ref_slope) > diff_max or current_slope <= diff_min:
-                is_same = False
-                # need to check if this is correct
-                if wrong_x_points and wrong_y_points:
-                    if (testpointnearestxval / feature_rate) - (previous_x_testpoint / feature_rate) > area_diff \
-                            or (pathval / feature_rate) - (previous_y_testpoint / feature_rate) > area_diff:
-                        wrong_x_points.append(previous_x_testpoint / feature_rate)
-                        wrong_y_points.append(previous_y_testpoint / feature_rate)
-                        wrong_x_points.append(testpointnearestxval / feature_rate)
-                        wrong_y_points.append(pathval / feature_rate)
-                    else:
-                        wrong_x_points.append(testpointnearestxval / feature_rate)
-                        wrong_y_points.append(pathval / feature_rate)
-                else:
-                    wrong_x_points.append(previous_x_testpoint / feature_rate)
-                    wrong_y_points.append(previous_y_testpoint / feature_rate)
-                    wrong_x_points.append(testpointnearestxval / feature_rate)
-                    wrong_y_points.append(pathval / feature_rate)
-
-        else:
-            testpointxval = refpoint1xval + i * testpointstep + testpointxshift  # finding the value for testing
-            testpointnearestxval = find_nearest(pathx, testpointxval)  # finding the nearest value to the test value
-            testpointxpos = np.argwhere(pathx == testpointnearestxval)[0]
-            pathval = float(pathy[testpointxpos])  # finding the value that matches the index found in the previous step
-
-            list_of_x_points.append(testpointnearestxval)
-            list_of_y_points.append(pathval)
-
-    result_max = max(list_of_slopes)
-    result_min = min(list_of_slopes)
-
-    if debug:
-        print(f'Result_max: {result_max}')
-        print(f'Result_min: {result_min}')
-
-    # print(f'////////////////// wrong points')
-    # print(wrong_x_points)
-    # print(wrong_y_points)
-    #
-    # ref_x_points_table = [True]
-    # diff_regions = {}
-    # if wrong_x_points:
-    #     for wrong_x, wrong_x_shift in zip(wrong_x_points[:-1], wrong_x_points[1:]):
-    #         current_diff = wrong_x_shift - wrong_x
-    #         if current_diff >= area_diff:
-    #             ref_x_points_table.append(False)
-    #         else:
-    #             ref_x_points_table.append(True)
-    #
-    #     if all(item for item in ref_x_points_table):
-    # print(f'ref x points table: {ref_x_points_table}')
-
+    testpointxvals = refpoint1xval + np.arange(testpointsnum) * testpointstep + testpointxshift
+    testpointxpos = nearest_positions(values, first_positions, testpointxvals)
+    points_x = pathx[testpointxpos]
+    points_y = pathy[testpointxpos].astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = compute_slope(points_x[:-1], points_y[:-1], points_x[1:], points_y[1:])
+    is_wrong = (np.abs(slopes - ref_slope) > diff_max) | (slopes <= diff_min)
+    is_same = not is_wrong.any()
+
+    if debug and len(slopes):
+        print(f'Result_max: {slopes.max()}')
+        print(f'Result_min: {slopes.min()}')
+
+    # a wrong slope adds its end point, and also its start point if it is the
+    # first one or the jump from the start point is longer than area_diff
+    wrong = np.flatnonzero(is_wrong)
+    with_start = ((points_x[wrong + 1] / feature_rate) - (points_x[wrong] / feature_rate) > area_diff) | \
+                 ((points_y[wrong + 1] / feature_rate) - (points_y[wrong] / feature_rate) > area_diff)
+    with_start[:1] = True
+    keep = np.column_stack([with_start, np.ones(len(wrong), dtype=bool)]).ravel()
+    wrong_x_points = (np.column_stack([points_x[wrong], points_x[wrong + 1]]).ravel()[keep] /
+                      feature_rate).tolist()
+    wrong_y_points = (np.column_stack([points_y[wrong], points_y[wrong + 1]]).ravel()[keep] /
+                      feature_rate).tolist()
 
     # compute the areas of inaccurate synchronization
     ref_x_points_table = [True]
@@ -194,11 +134,10 @@ def verify_path_slope(warping_path, segmentdivider, pair_names, diff_max=3, area
                     diff_regions[i]['target'] = wrong_x_points[prev_idx:idx]
 
     if plotting:
-        plt.plot(pathx, pathy, color="black")
-        plt.title(f'{pair_names[0]}, {pair_names[1]}')
-        plt.plot(linex[refpoint1xval:refpoint2xval + 1], liney[refpoint1xval:refpoint2xval + 1])
-        plt.plot(refpointsx, refpointsy, 'o', markersize=8, color='blue')
-        plt.show()
+        # matplotlib is only needed for debugging and slows down imports
+        from memovision.duplicate_finder.plotting import plot_path_slope
+        plot_path_slope(pathx, pathy, points_x, points_y, is_wrong, pair_names,
+                        pathx[[refpoint1xpos, refpoint2xpos]], pathy[[refpoint1xpos, refpoint2xpos]])
 
     return is_same, diff_regions
 
@@ -214,8 +153,8 @@ def run_structure_checker(ref_filename, filenames, wps, segmentdivider=20, diff_
             filenames : list of str
                 Names of all target files (no extensions)
 
-            wps : list of str
-                Paths to all warping paths (without the reference itself)
+            wps : list of np.ndarray
+                Warping paths of all targets (without the reference itself)
 
             Returns
             -------
@@ -230,13 +169,12 @@ def run_structure_checker(ref_filename, filenames, wps, segmentdivider=20, diff_
     num_of_pairs = len(filenames)
 
     # Checking every combination if it has the same structure
-    for i, (target_filename, wp_path) in enumerate(zip(filenames, wps), start=1):
+    for i, (target_filename, wp) in enumerate(zip(filenames, wps), start=1):
 
         if debug:
             print(f"Checking files {ref_filename} vs. {target_filename} for structure differences ({i}/{num_of_pairs})")
         pair_names = [ref_filename, target_filename]
 
-        wp = np.load(wp_path)
         is_same, diff_regions = verify_path_slope(warping_path=wp, segmentdivider=segmentdivider,
                                                   pair_names=pair_names, diff_max=diff_max,
                                                   area_diff=area_diff, diff_min=diff_min, feature_rate=feature_rate,
@@ -284,18 +222,41 @@ def run_structure_checker(ref_filename, filenames, wps, segmentdivider=20, diff_
     return diff_recordings, diff_regions_list
 
 
-def run_duplicate_finder(chromas, filenames, img_paths, hash_thresh=0, debug=False):
-    """Compute hard duplicates using image hashing from chroma files.
+def chroma_phash(image_path):
+    # 64 bit perceptual hash of a chroma image as a hex string
+    return str(imagehash.phash(Image.open(image_path)))
+
+
+def hamming_distances(hashes):
+    # pairwise number of differing bits of 64 bit hashes
+    codes = np.array([int(h, 16) for h in hashes], dtype=np.uint64)
+    xor = np.bitwise_xor(codes[:, None], codes[None, :])
+    return np.unpackbits(xor.view(np.uint8), axis=-1).reshape(
+        len(codes), len(codes), -1).sum(axis=-1)
+
+
+def run_duplicate_finder(hashes, filenames, lengths=None, tunings=None, hash_thresh=0, max_length_diff=0.05,
+                         max_tuning_diff=10, debug=False):
+    """Find hard duplicates by comparing perceptual hashes of chroma images.
             Parameters
             ----------
-            chromas : list of str
-                Paths to all chroma files (including reference)
+            hashes : list of str
+                Hex phash of the chroma image of every file (including reference)
 
             filenames : list of str
                 Names of all files (no extensions)
 
-            img paths : list of str
-                Paths to the folders where img will be stored (should correspond to filenames)
+            lengths : list of float
+                Lengths of the files in seconds, None where unknown
+
+            tunings : list of float
+                Tunings of the files in cents, None where unknown
+
+            max_length_diff : float
+                Relative difference in length above which two files are never duplicates
+
+            max_tuning_diff : float
+                Difference in tuning in cents above which two files are never duplicates
 
             Returns
             -------
@@ -303,44 +264,28 @@ def run_duplicate_finder(chromas, filenames, img_paths, hash_thresh=0, debug=Fal
                 Filenames of duplicates in pairs
             """
 
-    if len(chromas) != len(filenames):
-        raise Exception('Len of chromas and filenames must be the same!')
+    if len(hashes) != len(filenames):
+        raise Exception('Len of hashes and filenames must be the same!')
 
     files_number = len(filenames)
-
-    filenames_pairs = []
-    files_images = []
-    for i in range(0, files_number):
-        for j in range(i + 1, files_number):
-            filenames_pairs.append([filenames[i], filenames[j]])
-            files_images.append([img_paths[i], img_paths[j]])
-
-    num_of_pairs = len(filenames_pairs)
-    duplicates = []
-
-    # Checking every pair if it is a duplicate
-    for i, (filePairName, img_pair) in enumerate(zip(filenames_pairs, files_images), start=1):
-        file1_name = filePairName[0]
-        file2_name = filePairName[1]
-        image1_dir = img_pair[0]
-        image2_dir = img_pair[1]
-        is_duplicate = img_hash(image1_dir, image2_dir, hash_thresh, debug=debug)
-        if debug:
-            print(f'Checking if {file1_name} and {file2_name} are duplicates: {str(is_duplicate)}; '
-                  f'[{str(i)}/{str(num_of_pairs)}]')
-        if is_duplicate:
-            duplicates.append([file1_name, file2_name])
-
-    return duplicates
-
-
-def img_hash(file1, file2, hash_thresh, debug=False):
-    hash1 = imagehash.phash(Image.open(file1))
-    hash2 = imagehash.phash(Image.open(file2))
-    hash_diff = abs(hash1 - hash2)
+    if files_number < 2:
+        return []
+
+    # pairs that clearly differ in length or tuning are not compared
+    candidates = np.triu(np.ones((files_number, files_number), dtype=bool), k=1)
+    if lengths is not None:
+        lengths = np.array([np.nan if v is None else v for v in lengths], dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            length_diff = np.abs(lengths[:, None] - lengths[None, :]) / np.maximum(lengths[:, None], lengths[None, :])
+        candidates &= ~(length_diff > max_length_diff)
+    if tunings is not None:
+        tunings = np.array([np.nan if v is None else v for v in tunings], dtype=float)
+        candidates &= ~(np.abs(tunings[:, None] - tunings[None, :]) > max_tuning_diff)
+
+    hash_diff = hamming_distances(hashes)
     if debug:
-        print(f'Hash diff: {hash_diff}')
-    below_thresh_hard = False
-    if hash_diff <= hash_thresh:
-        below_thresh_hard = True
-    return below_thresh_hard
\ No newline at end of file
+        print(f'Hash diffs:\n{hash_diff}')
+
+    # pairs in the same order as the nested loop over i < j
+    rows, cols = np.nonzero(candidates & (hash_diff <= hash_thresh))
+    return [[filenames[i], filenames[j]] for i, j in zip(rows, cols)]
@@ -0,0 +1,36 @@
+import matplotlib.pyplot as plt
+import numpy as np
+
+
+def plot_path_slope(pathx, pathy, points_x, points_y, is_wrong, pair_names, refpointsx, refpointsy):
+    """Plot a warping path with the test points of the structure checker.
+            Parameters
+            ----------
+            pathx, pathy : np.ndarray
+                Reference and target frames of the warping path
+
+            points_x, points_y : np.ndarray
+                Test points on the path
+
+            is_wrong : np.ndarray
+                Whether the slope ending in each test point after the first is out of range
+
+            pair_names : list of str
+                Names of the reference and the target
+
+            refpointsx, refpointsy : np.ndarray
+                Points the reference slope is taken between
+            """
+    plt.figure()
+    for x, y, wrong in zip(points_x[1:], points_y[1:], is_wrong):
+        plt.plot(x, y, '+', markersize=12, color='red' if wrong else 'green')
+
+    # Line approximation
+    polynomial = np.poly1d(np.polyfit(refpointsx, refpointsy, 1))
+    linex = np.arange(refpointsx[0], refpointsx[1] + 1)
+
+    plt.plot(pathx, pathy, color="black")
+    plt.title(f'{pair_names[0]}, {pair_names[1]}')
+    plt.plot(linex, polynomial(linex))
+    plt.plot(refpointsx, refpointsy, 'o', markersize=8, color='blue')
+    plt.show()
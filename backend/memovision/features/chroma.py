@@ -0,0 +1,265 @@
+import traceback
+
+import numpy as np
+from madmom.audio import Signal
+
+from memovision.audio import load_audio
+from memovision.blob_store import (artifact_key, fetch_artifact,
+                                   store_artifact, unshare)
+from memovision.duplicate_finder.functions import (chroma_phash,
+                                                   save_chromaImage)
+from memovision.helpers.functions import (chroma_profile, chunk_sec,
+                                          compute_cens,
+                                          compute_pitch_from_audio,
+                                          extract_chunked, feature_rate,
+                                          get_chroma_features_from_pitch,
+                                          resample_signal)
+from memovision.model_registry import use_model
+
+# every stage persists one artifact and has a boolean flag of the same name
+# on the track, a stage only reads the artifacts of the stages it depends on
+CHROMA_STAGES = {
+    'pitch': {
+        'artifact': 'pitch.npy',
+        'depends': []
+    },
+    'chroma': {
+        'artifact': 'chroma.npy',
+        'depends': ['pitch']
+    },
+    'cens': {
+        'artifact': 'cens.npy',
+        'depends': ['chroma']
+    },
+    'chroma_image': {
+        'artifact': 'chroma.png',
+        'depends': ['chroma']
+    },
+    'deep_chroma': {
+        'artifact': 'deep_chroma.npy',
+        'depends': []
+    },
+    'chords': {
+        'artifact': 'chords.txt',
+        'depends': ['deep_chroma']
+    },
+    'act_func': {
+        'artifact': 'beatfun.npy',
+        'depends': []
+    }
+}
+
+# stages needed by synchronization and the duplicate finder
+SYNC_STAGES = ['chroma', 'cens', 'chroma_image']
+
+# the filterbank only covers the 88 piano keys, the remaining rows of the
+# 128 midi pitches are always zero and are not stored
+PITCH_MIDI_MIN = 21
+PITCH_MIDI_MAX = 108
+
+# frame rate of the madmom deep chroma extractor
+DEEP_CHROMA_RATE = 10
+
+
+def load_pitch(path, start=0, stop=None):
+    """Load stored pitch features.
+            Parameters
+            ----------
+            path : str
+                Path of pitch.npy
+
+            start, stop : int
+                Range of frames to load, the file is memory mapped so only
+                the range is read
+
+            Returns
+            -------
+            f_pitch : np.ndarray
+                Float64 pitch features of shape (128, N) as returned by
+                synctoolbox, rows outside of the piano range are zero
+            """
+    stored = np.load(path, mmap_mode='r')[:, start:stop]
+    f_pitch = np.zeros((128, stored.shape[1]))
+    f_pitch[PITCH_MIDI_MIN:PITCH_MIDI_MAX + 1] = stored
+    return f_pitch
+
+
+def compute_pitch(ctx, path):
+    f_pitch, ctx['updates']['tuning_cents'] = compute_pitch_from_audio(
+        ctx['path_22'],
+        tuning_offset=ctx['tuning_cents'],
+        midi_min=PITCH_MIDI_MIN,
+        midi_max=PITCH_MIDI_MAX)
+    with open(path, 'wb') as f:
+        np.save(f, f_pitch)
+
+
+def compute_chroma(ctx, path):
+    # chroma and its quantization are computed frame by frame, so the pitch
+    # features are read in blocks
+    pitch_path = f'{ctx["features_dir"]}/pitch.npy'
+    num_frames = np.load(pitch_path, mmap_mode='r').shape[1]
+    block = chunk_sec * feature_rate
+    chroma = np.zeros((12, num_frames))
+    for start in range(0, num_frames, block):
+        chroma[:, start:start + block] = get_chroma_features_from_pitch(
+            load_pitch(pitch_path, start, start + block))
+    with open(path, 'wb') as f:
+        np.save(f, chroma)
+
+
+def compute_cens_features(ctx, path):
+    chroma = np.load(f'{ctx["features_dir"]}/chroma.npy')
+    with open(path, 'wb') as f:
+        np.save(f, compute_cens(chroma))
+
+
+def compute_chroma_image(ctx, path):
+    save_chromaImage(f'{ctx["features_dir"]}/chroma.npy', path)
+
+
+def compute_deep_chroma(ctx, path):
+    processor = use_model('deep_chroma')
+    deep_chroma = np.concatenate(extract_chunked(
+        ctx['path_44'],
+        lambda audio: processor(Signal(audio, sample_rate=44100)).T,
+        sr=44100,
+        frame_rate=DEEP_CHROMA_RATE),
+                                 axis=1).T
+    with open(path, 'wb') as f:
+        np.save(f, deep_chroma)
+
+
+def compute_chords(ctx, path):
+    deep_chroma = np.load(f'{ctx["features_dir"]}/deep_chroma.npy')
+    chords = use_model('chord_recognition')(deep_chroma)
+    with open(path, 'wb') as f:
+        np.savetxt(f, chords, fmt='%s')
+
+
+def compute_act_func(ctx, path):
+    # the rnn of madmom runs at 100 fps, warping paths use 50 fps
+    audio_44, sr = load_audio(ctx['path_44'], sr=44100)
+    act_fun = use_model('beat_activation')(Signal(audio_44, sample_rate=sr))
+    with open(path, 'wb') as f:
+        np.save(f, resample_signal(act_fun, sr_in=100, sr_out=50))
+
+
+stage_functions = {
+    'pitch': compute_pitch,
+    'chroma': compute_chroma,
+    'cens': compute_cens_features,
+    'chroma_image': compute_chroma_image,
+    'deep_chroma': compute_deep_chroma,
+    'chords': compute_chords,
+    'act_func': compute_act_func
+}
+
+
+def stages_to_run(stages, done):
+    # requested stages and their dependencies in pipeline order
+    needed = set()
+    pending = list(stages)
+    while pending:
+        stage = pending.pop()
+        if stage not in needed and stage not in done:
+            needed.add(stage)
+            pending.extend(CHROMA_STAGES[stage]['depends'])
+    return [stage for stage in CHROMA_STAGES if stage in needed]
+
+
+def run_stage(stage, ctx):
+    artifact = CHROMA_STAGES[stage]['artifact']
+    path = f'{ctx["features_dir"]}/{artifact}'
+    key = artifact_key(artifact, feature_rate=50)
+    if fetch_artifact(ctx['username'], ctx['content_hash'], key, path):
+        return
+    unshare(path)
+    stage_functions[stage](ctx, path)
+    store_artifact(ctx['username'], ctx['content_hash'], key, path)
+
+
+def run_chroma_stages(stages, done, username, content_hash, features_dir,
+                      path_22, path_44, tuning_cents):
+    """Run the requested stages of the chroma pipeline for a single track.
+            Does not touch the database, so it can run in a pool process.
+
+            Parameters
+            ----------
+            stages : list
+                Stages to produce, their dependencies are added automatically
+
+            done : list
+                Stages whose artifacts are already in place
+
+            username : str
+                Owner of the blob store the artifacts are shared through
+
+            content_hash : str
+                Content hash of the track or None
+
+            features_dir : str
+                Folder the artifacts are written to
+
+            path_22, path_44 : str
+                Analysis and playback renditions
+
+            tuning_cents : float
+                Tuning estimated at upload or None
+
+            Returns
+            -------
+            finished : list
+                Stages that completed, in pipeline order
+
+            updates : dict
+                Track attributes derived by the stages, the tuning used for
+                the pitch features, the chroma profile and the chroma phash
+
+            error : str
+                Failed stage and its error, None if all stages completed
+            """
+    ctx = {
+        'username': username,
+        'content_hash': content_hash,
+        'features_dir': features_dir,
+        'path_22': path_22,
+        'path_44': path_44,
+        'tuning_cents': tuning_cents,
+        'updates': {}
+    }
+    finished = []
+    for stage in stages_to_run(stages, done):
+        try:
+            run_stage(stage, ctx)
+            if stage == 'cens':
+                # the profile is also derived when cens came from the store
+                ctx['updates']['chroma_profile'] = chroma_profile(
+                    np.load(f'{features_dir}/cens.npy')).tolist()
+            elif stage == 'chroma_image':
+                # hashed once here instead of on every duplicate search
+                ctx['updates']['chroma_phash'] = chroma_phash(
+                    f'{features_dir}/chroma.png')
+        except Exception as e:
+            # earlier stages stay finished and are not redone on retry
+            traceback.print_exc()
+            return finished, ctx['updates'], f'{stage}: {e}'
+        finished.append(stage)
+    return finished, ctx['updates'], None
+
+
+def completed_stages(track):
+    return [stage for stage in CHROMA_STAGES if getattr(track, stage)]
+
+
+def stage_args(username, track):
+    features_dir = f'./user_uploads/{username}/{track.session.name}/{track.filename}/features'
+    return (username, track.content_hash, features_dir, track.path_22,
+            track.path_44, track.tuning_cents)
+
+
+def apply_stages(track, finished, updates):
+    for stage in finished:
+        setattr(track, stage, True)
+    for key, value in updates.items():
+        setattr(track, key, value)
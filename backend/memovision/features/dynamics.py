@@ -1,7 +1,7 @@
 import numpy as np
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import current_user, jwt_required
-from librosa import load
+from memovision.audio import load_audio
 from memovision.db_models import Session, Track
 from memovision.features.extractors import compute_loudness, compute_rms
 from memovision.features.relevance import compute_relevance
@@ -58,7 +58,7 @@ def rms(filename):
     if (request.method == 'PUT'):
         track = Track.query.filter_by(session_id=session.id,
                                       filename=filename).first()
-        y, sr = load(track.path_22, sr=22050, mono=True)
+        y, sr = load_audio(track.path_22, sr=22050)
         rms_array = compute_rms(y)
         np.save(
             f'./user_uploads/{current_user.username}/{session.name}/{filename}/features/rms.npy',
@@ -91,7 +91,7 @@ def loudness(filename):
     if (request.method == 'PUT'):
         track = Track.query.filter_by(session_id=session.id,
                                       filename=filename).first()
-        y, sr = load(track.path_22, sr=22050, mono=True)
+        y, sr = load_audio(track.path_22, sr=22050)
         loudness_array = compute_loudness(y, sr=22050)
         np.save(
             f'./user_uploads/{current_user.username}/{session.name}/{filename}/features/loudness.npy',
@@ -4,7 +4,6 @@ import sys
 from math import floor
 
 import numpy as np
-import scipy
 from madmom.audio.signal import FramedSignalProcessor, SignalProcessor
 from madmom.audio.spectrogram import (FilteredSpectrogramProcessor,
                                       LogarithmicSpectrogramProcessor)
@@ -19,9 +18,33 @@ from synctoolbox.feature.chroma import (pitch_to_chroma, quantize_chroma,
 from synctoolbox.feature.pitch import audio_to_pitch_features
 from synctoolbox.feature.utils import estimate_tuning
 
+from memovision.audio import (ANALYSIS_CODEC, ANALYSIS_EXT, PLAYBACK_CODEC,
+                              PLAYBACK_EXT, audio_info, load_audio)
+
 feature_rate = 50
+# preview paths are computed on chroma averaged down to this rate
+preview_feature_rate = 10
 step_weights = np.array([1.5, 1.5, 2.0])
 threshold_rec = 10**6
+# smoothing windows and downsampling factors of the mrmsdtw levels, the
+# defaults of synctoolbox for full resolution and scaled ones for previews,
+# synctoolbox requires the finest level to be (1, 1)
+win_len_smooth = np.array([201, 101, 21, 1])
+downsamp_smooth = np.array([50, 25, 5, 1])
+preview_win_len_smooth = np.array([41, 21, 1])
+preview_downsamp_smooth = np.array([10, 5, 1])
+# at most this many coarser levels are added to fit a memory budget, each
+# doubles the smoothing window of the coarsest level
+max_extra_levels = 2
+# bytes per cell of the cost, accumulated cost and step matrices plus
+# temporaries, and bytes per frame of the features kept for all levels
+dtw_bytes_per_cell = 32
+dtw_bytes_per_frame = 12 * 8 * 8
+# feature extraction decodes the audio in blocks of chunk_sec with
+# chunk_margin_sec of context on both sides, which covers the decay of the
+# lowest pitch filters and the context window of the deep chroma network
+chunk_sec = 60
+chunk_margin_sec = 5
 
 # def convert_audio(audio_path, sr=22050, mono=True, db_level=-23):
 #     dirname, filename = os.path.split(audio_path)
@@ -37,61 +60,338 @@ threshold_rec = 10**6
 #     return filename_out
 
 
-def convert_audio(audio_path, sr=22050, mono=True):
+def codec_option(codec):
+    # without a codec ffmpeg uses the default encoder of the container
+    return f'-c:a {codec} ' if codec else ''
+
+
+def convert_audio(audio_path, sr_playback=44100, sr_analysis=22050):
+    # decode once and write both renditions: stereo for playback in the
+    # browser and mono for the feature extractors
     dirname, filename = os.path.split(audio_path)
-    filename_out = dirname + '/' + os.path.splitext(filename)[0] + f'_{sr}.ogg'
+    basename = dirname + '/' + os.path.splitext(filename)[0]
+    path_playback = basename + f'_{sr_playback}.{PLAYBACK_EXT}'
+    path_analysis = basename + f'_{sr_analysis}.{ANALYSIS_EXT}'
     try:
-        if mono:
-            channels = '1'
-        else:
-            channels = '2'
-        cmd = 'ffmpeg -y -loglevel fatal -i "{}" -ac {} -ar {} -vn {} -f f32le -nostdin'.format(
-            audio_path, channels, sr, filename_out)
+        cmd = 'ffmpeg -y -loglevel fatal -nostdin -i "{}" -vn -ac 2 -ar {} {}"{}" -vn -ac 1 -ar {} {}"{}"'.format(
+            audio_path, sr_playback, codec_option(PLAYBACK_CODEC),
+            path_playback, sr_analysis, codec_option(ANALYSIS_CODEC),
+            path_analysis)
         subprocess.call(cmd, shell=True)
     except IOError:
         sys.exit(1)
-    return filename_out
+    num_samples = audio_info(path_analysis)['num_samples']
+    return path_playback, path_analysis, num_samples
 
 
 def strip_extension(filename):
     return os.path.splitext(filename)[0]
 
 
-def get_chroma_features_from_audio(audio,
-                                   tuning_offset,
-                                   Fs=22050,
-                                   feature_rate=50,
-                                   verbose=False):
+def get_pitch_features_from_audio(audio,
+                                  tuning_offset,
+                                  Fs=22050,
+                                  feature_rate=50,
+                                  verbose=False):
     f_pitch = audio_to_pitch_features(f_audio=audio,
                                       Fs=Fs,
                                       tuning_offset=tuning_offset,
                                       feature_rate=feature_rate,
                                       verbose=verbose)
+    return f_pitch
+
+
+def get_chroma_features_from_pitch(f_pitch):
     f_chroma = pitch_to_chroma(f_pitch=f_pitch)
     f_chroma_quantized = quantize_chroma(f_chroma=f_chroma)
     return f_chroma_quantized
 
 
-def compute_chroma_from_audio(audio_array, fs=22050):
-    tuning_offset = estimate_tuning(audio_array, fs)
-    f_chroma = get_chroma_features_from_audio(audio=audio_array,
-                                              tuning_offset=tuning_offset)
-    return f_chroma, tuning_offset
+def get_chroma_features_from_audio(audio,
+                                   tuning_offset,
+                                   Fs=22050,
+                                   feature_rate=50,
+                                   verbose=False):
+    f_pitch = get_pitch_features_from_audio(audio,
+                                            tuning_offset,
+                                            Fs=Fs,
+                                            feature_rate=feature_rate,
+                                            verbose=verbose)
+    return get_chroma_features_from_pitch(f_pitch)
+
+
+def estimate_tuning_from_excerpts(audio_path,
+                                  num_excerpts=16,
+                                  excerpt_sec=8,
+                                  sr=22050):
+    # the tuning histogram is averaged over time, so a bounded set of evenly
+    # spaced excerpts gives the same estimate as the full recording
+    num_samples = audio_info(audio_path)['num_samples']
+    excerpt_len = int(excerpt_sec * sr)
+    if num_samples <= num_excerpts * excerpt_len:
+        audio, _ = load_audio(audio_path, sr=sr)
+    else:
+        starts = np.linspace(0, num_samples - excerpt_len,
+                             num_excerpts).astype(int)
+        audio = np.concatenate([
+            load_audio(audio_path, sr=sr, start=start,
+                       stop=start + excerpt_len)[0] for start in starts
+        ])
+    return float(estimate_tuning(audio, sr))
+
+
+def cents_to_hz(tuning_offset_cents):
+    return round(440 * pow(2, tuning_offset_cents / 1200), 1)
+
+
+def chunk_bounds(num_samples, hop, chunk_frames, margin_frames):
+    # blocks of chunk_frames frames, each decoded with margin_frames of
+    # context on both sides so that filter transients fall into the margins,
+    # yields the decoded sample range and the frames kept from it, the last
+    # block keeps all frames up to the end of the signal
+    first = 0
+    while True:
+        last = first + chunk_frames
+        start = max(first - margin_frames, 0) * hop
+        stop = (last + margin_frames) * hop
+        if stop >= num_samples:
+            yield start, num_samples, first, None
+            return
+        yield start, stop, first, last
+        first = last
+
+
+def extract_chunked(audio_path,
+                    extract,
+                    sr,
+                    frame_rate,
+                    chunk_sec=chunk_sec,
+                    margin_sec=chunk_margin_sec):
+    """Extract frame features block by block from a stored rendition.
+            Blocks start on the frame grid, so the frames of a block are the
+            frames of the full signal shifted by a whole number of frames and
+            are stitched without resampling.
+
+            Parameters
+            ----------
+            audio_path : str
+                Rendition stored at sample rate sr
+
+            extract : callable
+                Maps a block of audio to features of shape (d, frames)
+
+            sr : int
+                Sample rate of the rendition
+
+            frame_rate : int
+                Frame rate of the features, sr must be a multiple of it
+
+            chunk_sec, margin_sec : float
+                Length of the blocks and of the context decoded around them
+
+            Returns
+            -------
+            features : list
+                Feature blocks of shape (d, frames) in temporal order
+            """
+    hop = sr // frame_rate
+    blocks = []
+    for start, stop, first, last in chunk_bounds(
+            audio_info(audio_path)['num_samples'], hop,
+            int(chunk_sec * frame_rate), int(margin_sec * frame_rate)):
+        audio, _ = load_audio(audio_path, sr=sr, start=start, stop=stop)
+        features = extract(audio)
+        offset = start // hop
+        blocks.append(features[:, first -
+                               offset:None if last is None else last - offset])
+        del audio, features
+    return blocks
+
+
+def compute_pitch_from_audio(audio_path,
+                             tuning_offset=None,
+                             midi_min=21,
+                             midi_max=108):
+    """Pitch features of a 22.05 kHz rendition, streamed in blocks.
+            Returns
+            -------
+            f_pitch : np.ndarray
+                Float16 pitch features of the midi pitches midi_min to
+                midi_max, the other rows of the filterbank are always zero
+
+            tuning_offset : float
+                Tuning used for the filterbank in cents
+            """
+    if tuning_offset is None:
+        tuning_offset = estimate_tuning_from_excerpts(audio_path)
+
+    def extract(audio):
+        f_pitch = get_pitch_features_from_audio(audio, tuning_offset)
+        return f_pitch[midi_min:midi_max + 1].astype(np.float16)
+
+    blocks = extract_chunked(audio_path, extract, 22050, feature_rate)
+    return np.concatenate(blocks, axis=1), tuning_offset
+
+
+def downsample_features(features, factor):
+    # average non-overlapping blocks of frames, the last block is zero padded
+    num_frames = int(np.ceil(features.shape[1] / factor))
+    padded = np.zeros((features.shape[0], num_frames * factor))
+    padded[:, :features.shape[1]] = features
+    return padded.reshape(features.shape[0], num_frames, factor).mean(axis=2)
+
+
+def compute_cens(chroma):
+    return quantized_chroma_to_CENS(chroma, 201, 50, feature_rate)[0]
+
+
+def chroma_profile(cens):
+    # time-averaged pitch class distribution, a 12-d summary of the track
+    profile = cens.sum(axis=1)
+    norm = np.linalg.norm(profile)
+    return profile / norm if norm > 0 else profile
+
+
+def profile_chroma_shifts(ref_profile, profiles, margin=0.05):
+    """Chroma shifts of many tracks against a reference from their profiles.
+            Parameters
+            ----------
+            ref_profile : np.ndarray
+                Chroma profile of the reference of shape (12, )
+
+            profiles : np.ndarray
+                Chroma profiles of the targets of shape (num_targets, 12)
+
+            margin : float
+                Minimal difference between the best and the second best
+                circular correlation for a shift to be accepted
+
+            Returns
+            -------
+            shifts : list
+                Shift for shift_chroma_vectors per target, None where the
+                profiles are ambiguous and the shift has to be found via dtw
+            """
+    profiles = np.atleast_2d(profiles)
+    # rolled[t, s] equals np.roll(profiles[t], s)
+    idx = (np.arange(12)[np.newaxis, :] - np.arange(12)[:, np.newaxis]) % 12
+    rolled = profiles[:, idx]
+    scores = rolled @ ref_profile
+    order = np.argsort(scores, axis=1)
+    best = order[:, -1]
+    rows = np.arange(len(profiles))
+    confident = scores[rows, best] - scores[rows, order[:, -2]] >= margin
+    return [int(b) if c else None for b, c in zip(best, confident)]
+
+
+def mrmsdtw_settings(num_frames1,
+                     num_frames2,
+                     memory_budget_mb=None,
+                     preview=False):
+    """Multiresolution levels of mrmsdtw that fit into a memory budget.
+            The coarsest level is solved by a full dtw, so up to
+            max_extra_levels levels with larger windows are added in front
+            until its cost matrix fits. The finer levels are split
+            recursively into pieces of at most threshold_rec cells, the
+            finest level always stays at the input feature rate.
+
+            Parameters
+            ----------
+            num_frames1, num_frames2 : int
+                Number of feature frames of both tracks
+
+            memory_budget_mb : float
+                Memory available to the alignment, None keeps the defaults
+
+            preview : bool
+                Settings for the preview feature rate
+
+            Returns
+            -------
+            settings : dict
+                win_len_smooth, downsamp_smooth and threshold_rec keyword
+                arguments for sync_via_mrmsdtw
+
+            Raises
+            ------
+            MemoryError
+                If the budget cannot hold the features or the coarsest dtw
+            """
+    win_lens = list(preview_win_len_smooth if preview else win_len_smooth)
+    factors = list(preview_downsamp_smooth if preview else downsamp_smooth)
+    if memory_budget_mb is None:
+        return {
+            'win_len_smooth': np.array(win_lens),
+            'downsamp_smooth': np.array(factors),
+            'threshold_rec': threshold_rec
+        }
+    features_mb = dtw_bytes_per_frame * (num_frames1 + num_frames2) / 1024**2
+    budget_cells = (memory_budget_mb -
+                    features_mb) * 1024**2 / dtw_bytes_per_cell
+    if budget_cells < 10**4:
+        raise MemoryError(
+            f'the sync memory budget of {memory_budget_mb:.0f} MB cannot hold '
+            f'the features of both tracks ({features_mb:.0f} MB), increase '
+            'memory_budget_mb in the [sync] section of config.ini')
+    for _ in range(max_extra_levels):
+        if (num_frames1 / factors[0]) * (num_frames2 /
+                                         factors[0]) <= budget_cells / 2:
+            break
+        win_lens.insert(0, 2 * win_lens[0] - 1)
+        factors.insert(0, 2 * factors[0])
+    if (num_frames1 / factors[0]) * (num_frames2 /
+                                     factors[0]) > budget_cells / 2:
+        raise MemoryError(
+            f'the sync memory budget of {memory_budget_mb:.0f} MB is too '
+            'small for the coarsest alignment of these tracks, increase '
+            'memory_budget_mb in the [sync] section of config.ini')
+    return {
+        'win_len_smooth': np.array(win_lens),
+        'downsamp_smooth': np.array(factors),
+        'threshold_rec': int(min(max(budget_cells / 4, 10**4), 10**8))
+    }
 
 
 def compute_dtw_path(ref_chroma,
                      target_chroma,
                      ref_onset=None,
                      target_onset=None,
-                     with_onsets=False):
-    # compute optimal chroma shift
-    opt_chroma_shift = compute_optimal_chroma_shift(
-        quantized_chroma_to_CENS(ref_chroma, 201, 50, feature_rate)[0],
-        quantized_chroma_to_CENS(target_chroma, 201, 50, feature_rate)[0])
+                     with_onsets=False,
+                     ref_cens=None,
+                     target_cens=None,
+                     chroma_shift=None,
+                     preview=False,
+                     memory_budget_mb=None):
+    # compute optimal chroma shift unless it is known from the chroma
+    # profiles, stored cens features can be passed in to skip the smoothing
+    opt_chroma_shift = chroma_shift
+    if opt_chroma_shift is None:
+        if ref_cens is None:
+            ref_cens = compute_cens(ref_chroma)
+        if target_cens is None:
+            target_cens = compute_cens(target_chroma)
+        opt_chroma_shift = compute_optimal_chroma_shift(ref_cens, target_cens)
     # shift target chroma
     target_chroma = shift_chroma_vectors(target_chroma, opt_chroma_shift)
     # compute warping path via mrmsdtw
-    if with_onsets:
+    if preview:
+        # coarse path at preview_feature_rate, onsets are left to the
+        # refinement at full resolution
+        factor = feature_rate // preview_feature_rate
+        ref_chroma = downsample_features(ref_chroma, factor)
+        target_chroma = downsample_features(target_chroma, factor)
+    settings = mrmsdtw_settings(ref_chroma.shape[1],
+                                target_chroma.shape[1],
+                                memory_budget_mb=memory_budget_mb,
+                                preview=preview)
+    if preview:
+        wp = sync_via_mrmsdtw(f_chroma1=ref_chroma,
+                              f_chroma2=target_chroma,
+                              input_feature_rate=preview_feature_rate,
+                              step_weights=step_weights,
+                              verbose=False,
+                              **settings)
+    elif with_onsets:
         ref_onset = pad_act_fun(ref_onset, ref_chroma.shape[1])
         target_onset = pad_act_fun(target_onset, target_chroma.shape[1])
 
@@ -101,26 +401,25 @@ def compute_dtw_path(ref_chroma,
                               f_onset2=target_onset,
                               input_feature_rate=feature_rate,
                               step_weights=step_weights,
-                              threshold_rec=threshold_rec,
-                              verbose=False)
+                              verbose=False,
+                              **settings)
 
     else:
         wp = sync_via_mrmsdtw(f_chroma1=ref_chroma,
                               f_chroma2=target_chroma,
                               input_feature_rate=feature_rate,
                               step_weights=step_weights,
-                              threshold_rec=threshold_rec,
-                              verbose=False)
+                              verbose=False,
+                              **settings)
     # return make_path_strictly_monotonic(wp)
     return wp
 
 
-def transfer_step_annotations(step, ref_duration, target_duration, wp):
+def transfer_step_annotations(step, ref_duration, target_duration,
+                              time_map):
     ref_steps = floor(ref_duration / step)
     ref_positions = list(np.linspace(step, ref_steps * step, ref_steps))
-    target_steps = list(
-        scipy.interpolate.interp1d(wp[0] / 50, wp[1] / 50,
-                                   kind='linear')(ref_positions))
+    target_steps = list(np.interp(ref_positions, *time_map))
     return [0] + target_steps + [target_duration]
 
 
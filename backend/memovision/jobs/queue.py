@@ -0,0 +1,145 @@
+import multiprocessing
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+from memovision import create_app, db
+from memovision.app_config import Config
+from memovision.db_models import Job
+
+
+def enqueue_job(kind, user, track=None, payload=None):
+    # the job is picked up by a worker process once the caller commits
+    job = Job(kind=kind,
+              user_id=user.id,
+              track=track,
+              status='queued',
+              progress=0,
+              payload=payload or {},
+              created_at=datetime.now())
+    db.session.add(job)
+    return job
+
+
+def set_progress(job, progress):
+    job.progress = progress
+    db.session.commit()
+
+
+def update_payload(job, **kwargs):
+    # json columns do not track in-place changes, assign a new dict instead
+    payload = dict(job.payload or {})
+    payload.update(kwargs)
+    job.payload = payload
+
+
+def map_in_pool(func, args_list, pool_size=2, initializer=None, initargs=()):
+    # yield (index, result, error) in the order the items finish
+    with ProcessPoolExecutor(max_workers=pool_size,
+                             initializer=initializer,
+                             initargs=initargs) as pool:
+        futures = {
+            pool.submit(func, *args): i
+            for i, args in enumerate(args_list)
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                traceback.print_exc()
+                yield futures[future], None, e
+
+
+def fail_stale_jobs(stale_after=Config.JOB_STALE_AFTER):
+    # running jobs whose worker stopped sending heartbeats have crashed,
+    # they are failed rather than requeued so that a job crashing its
+    # worker is not retried forever
+    from memovision.jobs.tasks import on_failure
+    deadline = datetime.now() - timedelta(seconds=stale_after)
+    last_seen = db.func.coalesce(Job.heartbeat_at, Job.started_at)
+    stale_jobs = Job.query.filter(
+        Job.status == 'running',
+        last_seen < deadline).with_for_update(skip_locked=True).all()
+    for job in stale_jobs:
+        job.status = 'failed'
+        job.error = 'worker stopped responding'
+        job.finished_at = datetime.now()
+        on_failure(job)
+    db.session.commit()
+
+
+def claim_next_job():
+    # skip rows locked by other workers so that every job runs only once
+    job = Job.query.filter_by(status='queued').order_by(
+        Job.id.asc()).with_for_update(skip_locked=True).first()
+    if job:
+        job.status = 'running'
+        job.started_at = datetime.now()
+        job.heartbeat_at = job.started_at
+    db.session.commit()
+    return job
+
+
+def send_heartbeats(engine, job_id, stop, interval):
+    # runs in a thread next to the job, with its own connection so that it
+    # never commits the job's session
+    while not stop.wait(interval):
+        with engine.begin() as connection:
+            connection.execute(
+                db.update(Job).where(Job.id == job_id).values(
+                    heartbeat_at=datetime.now()))
+
+
+def run_job(job):
+    from memovision.jobs.tasks import on_failure, tasks
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=send_heartbeats,
+                                 args=(db.engine, job.id, stop,
+                                       Config.JOB_HEARTBEAT_INTERVAL),
+                                 daemon=True)
+    heartbeat.start()
+    error = None
+    try:
+        tasks[job.kind](job)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        traceback.print_exc()
+        error = e
+    # the job row is not locked by this session any more, so a heartbeat in
+    # flight can finish before the thread is joined
+    stop.set()
+    heartbeat.join()
+    if error is None:
+        job.status = 'done'
+        job.progress = 1
+    else:
+        job.status = 'failed'
+        job.error = str(error)
+        on_failure(job)
+    job.finished_at = datetime.now()
+    db.session.commit()
+
+
+def work(poll_interval=1.0):
+    app = create_app()
+    with app.app_context():
+        while True:
+            fail_stale_jobs()
+            job = claim_next_job()
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_job(job)
+
+
+def start_workers(num_workers=2, poll_interval=1.0):
+    workers = []
+    for _ in range(num_workers):
+        worker = multiprocessing.Process(target=work, args=(poll_interval, ))
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
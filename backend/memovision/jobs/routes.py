@@ -0,0 +1,15 @@
+from flask import Blueprint, jsonify
+from flask_jwt_extended import current_user, jwt_required
+
+from memovision.db_models import Job
+
+jobs = Blueprint('jobs', __name__)
+
+
+@jobs.route('/jobs/<int:job_id>', methods=['GET'])
+@jwt_required()
+def get_job(job_id):
+    job = Job.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({'message': 'job not found'}), 404
+    return jsonify({'message': 'success', 'job': job.get_data()})
@@ -0,0 +1,253 @@
+import os
+import shutil
+import subprocess
+
+from memovision import db
+from memovision.app_config import Config
+from memovision.audio import renditions_disk_space
+from memovision.blob_store import (release_blob, restore_renditions,
+                                   store_renditions)
+from memovision.db_models import Track
+from memovision.features.chroma import (apply_stages, completed_stages,
+                                        run_chroma_stages, stage_args,
+                                        stages_to_run)
+from memovision.helpers.functions import (cents_to_hz, convert_audio,
+                                          estimate_tuning_from_excerpts)
+from memovision.jobs.queue import (enqueue_job, map_in_pool, set_progress,
+                                   update_payload)
+from memovision.sync import (chroma_shifts, load_reference,
+                             set_pool_reference, sync_pool_target, track_dir)
+from memovision.waveform import build_pyramid
+
+
+def convert_upload(filepath):
+    # convert to a stereo 44100 Hz and a mono 22050 Hz rendition via ffmpeg
+    path_44, path_22, num_samples = convert_audio(filepath)
+    audiowaveform_path = path_44[:-4] + '.dat'
+    audiowaveform_cmd = f'audiowaveform -i {path_44} -o {audiowaveform_path} -b 8 -q -z 32'
+    subprocess.call(audiowaveform_cmd, shell=True)
+    pyramid = build_pyramid(audiowaveform_path)
+    disk_space = renditions_disk_space(path_44, path_22, audiowaveform_path,
+                                       *pyramid)
+    length_sec = num_samples / 22050
+    tuning_offset_cents = estimate_tuning_from_excerpts(path_22)
+    # remove original file
+    os.remove(filepath)
+    return {
+        'length_sec': length_sec,
+        'path_44': path_44,
+        'path_22': path_22,
+        'disk_space': disk_space,
+        'tuning_offset': cents_to_hz(tuning_offset_cents),
+        'tuning_cents': tuning_offset_cents
+    }
+
+
+def set_track_data(track, data):
+    for key, value in data.items():
+        setattr(track, key, value)
+    track.status = 'ready'
+
+
+def restore_upload(username, track, filepath):
+    # an identical file was converted before, link its renditions instead
+    if not track.content_hash:
+        return None
+    data = restore_renditions(username, track.content_hash,
+                              os.path.dirname(filepath), track.filename)
+    if data is not None:
+        build_pyramid(data['path_44'][:-4] + '.dat')
+        os.remove(filepath)
+    return data
+
+
+def publish_upload(username, track, data):
+    if track.content_hash:
+        store_renditions(username, track.content_hash, data,
+                         data['path_44'][:-4] + '.dat')
+
+
+def discard_track(user, track):
+    # a track whose upload could not be converted is removed with its
+    # folder, so that the file can be uploaded again
+    folder = track_dir(user.username, track)
+    content_hash = track.content_hash
+    db.session.delete(track)
+    shutil.rmtree(folder, ignore_errors=True)
+    release_blob(user, content_hash)
+
+
+def ingest_track(job):
+    track = job.track
+    if track is None:
+        # track was deleted before the job was picked up
+        return
+    filepath = job.payload['filepath']
+    data = restore_upload(job.user.username, track, filepath)
+    if data is None:
+        data = convert_upload(filepath)
+        publish_upload(job.user.username, track, data)
+    set_track_data(track, data)
+    db.session.commit()
+
+
+def ingest_batch(job):
+    username = job.user.username
+    files = [dict(f) for f in job.payload['files']]
+    tracks = [Track.query.filter_by(id=f['track_id']).first() for f in files]
+    results = {}
+    to_convert = []
+    for i, (f, track) in enumerate(zip(files, tracks)):
+        data = None
+        if track is not None:
+            data = restore_upload(username, track, f['filepath'])
+        if data is None:
+            to_convert.append(i)
+        else:
+            results[i] = data
+            f['status'] = 'ready'
+    args_list = [(files[i]['filepath'], ) for i in to_convert]
+    for j, data, error in map_in_pool(convert_upload,
+                                      args_list,
+                                      pool_size=Config.JOB_POOL_SIZE):
+        i = to_convert[j]
+        files[i]['status'] = 'failed' if error else 'ready'
+        results[i] = data
+        if data is not None and tracks[i] is not None:
+            publish_upload(username, tracks[i], data)
+        update_payload(job, files=[dict(f) for f in files])
+        set_progress(job, len(results) / len(files))
+    # all track rows are updated in one transaction
+    for i, track in enumerate(tracks):
+        if track is None:
+            continue
+        if results.get(i):
+            set_track_data(track, results[i])
+        else:
+            discard_track(job.user, track)
+    update_payload(job, files=files)
+    db.session.commit()
+
+
+def chroma_session(job):
+    username = job.user.username
+    stages = job.payload['stages']
+    files = [dict(f) for f in job.payload['files']]
+    tracks = [Track.query.filter_by(id=f['track_id']).first() for f in files]
+    to_compute = []
+    for i, (f, track) in enumerate(zip(files, tracks)):
+        if track is None or not stages_to_run(stages,
+                                              completed_stages(track)):
+            # deleted or computed by a single-track request in the meantime
+            f['status'] = 'skipped'
+        else:
+            to_compute.append(i)
+    args_list = [(stages, completed_stages(tracks[i]),
+                  *stage_args(username, tracks[i])) for i in to_compute]
+    num_done = len(files) - len(to_compute)
+    for j, result, error in map_in_pool(run_chroma_stages,
+                                        args_list,
+                                        pool_size=Config.JOB_POOL_SIZE):
+        i = to_compute[j]
+        if result is not None:
+            finished, updates, error = result
+            apply_stages(tracks[i], finished, updates)
+        files[i]['status'] = 'failed' if error else 'ready'
+        num_done += 1
+        update_payload(job, files=[dict(f) for f in files])
+        set_progress(job, num_done / len(files))
+    update_payload(job, files=files)
+    db.session.commit()
+
+
+def sync_session(job):
+    username = job.user.username
+    precise = job.payload['precise']
+    preview = job.payload.get('preview', False)
+    files = [dict(f) for f in job.payload['files']]
+    tracks = [Track.query.filter_by(id=f['track_id']).first() for f in files]
+    ref = Track.query.filter_by(id=job.payload['ref_id']).first()
+    if ref is None or not ref.reference:
+        # the reference changed after the job was queued
+        update_payload(job,
+                       files=[dict(f, status='skipped') for f in files])
+        return
+    # the reference is loaded and its cens computed once for all targets
+    reference = load_reference(username, ref, precise and not preview)
+    to_sync = []
+    for i, (f, track) in enumerate(zip(files, tracks)):
+        if track is None:
+            f['status'] = 'skipped'
+        else:
+            to_sync.append(i)
+    # chroma shifts of all targets from the stored profiles in one go
+    shifts = chroma_shifts(ref, [tracks[i] for i in to_sync])
+    # the memory budget of the job is shared by the pool processes
+    memory_budget_mb = Config.SYNC_MEMORY_BUDGET_MB / Config.JOB_POOL_SIZE
+    args_list = [(username, track_dir(username, tracks[i]),
+                  tracks[i].content_hash, tracks[i].length_sec, precise,
+                  shift, preview, memory_budget_mb)
+                 for i, shift in zip(to_sync, shifts)]
+    resolutions = {}
+    num_done = len(files) - len(to_sync)
+    for j, result, error in map_in_pool(sync_pool_target,
+                                        args_list,
+                                        pool_size=Config.JOB_POOL_SIZE,
+                                        initializer=set_pool_reference,
+                                        initargs=(reference, )):
+        i = to_sync[j]
+        files[i]['status'] = 'failed' if error else 'ready'
+        if error:
+            # e.g. a memory budget too small for the pair of tracks
+            files[i]['error'] = str(error)
+        if result is not None:
+            resolutions[i] = result['resolution']
+            files[i]['peak_memory_mb'] = result['peak_memory_mb']
+        num_done += 1
+        update_payload(job, files=[dict(f) for f in files])
+        set_progress(job, num_done / len(files))
+    errors = [files[i]['error'] for i in to_sync if 'error' in files[i]]
+    if to_sync and len(errors) == len(to_sync):
+        # nothing was synchronized, the job fails with the reason
+        raise RuntimeError(errors[0])
+    # the sync flags of all targets are set in one transaction
+    for i, (f, track) in enumerate(zip(files, tracks)):
+        if track is not None and f['status'] == 'ready':
+            track.sync = True
+            track.sync_resolution = resolutions[i]
+    update_payload(job, files=files)
+    if preview:
+        # provisional paths are upgraded to full resolution in the background
+        refine_files = [
+            dict(f, status='queued') for f in files if f['status'] == 'ready'
+        ]
+        if refine_files:
+            enqueue_job('sync-session',
+                        job.user,
+                        payload={
+                            'files': refine_files,
+                            'ref_id': ref.id,
+                            'precise': precise,
+                            'preview': False
+                        })
+    db.session.commit()
+
+
+def on_failure(job):
+    if job.track is not None and job.kind == 'ingest':
+        track = job.track
+        job.track = None
+        discard_track(job.user, track)
+    elif job.kind == 'ingest-batch':
+        for f in job.payload['files']:
+            track = Track.query.filter_by(id=f['track_id']).first()
+            if track is not None and track.status == 'converting':
+                discard_track(job.user, track)
+
+
+tasks = {
+    'ingest': ingest_track,
+    'ingest-batch': ingest_batch,
+    'chroma-session': chroma_session,
+    'sync-session': sync_session
+}
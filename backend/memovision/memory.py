@@ -0,0 +1,30 @@
+import sys
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, memory is then reported as None
+    resource = None
+
+
+def peak_rss_mb():
+    # peak resident set size of this process in megabytes, None if unknown
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macos and in kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return peak / 1024**2
+    return peak / 1024
+
+
+def reset_peak_rss():
+    # linux lets a process reset its peak rss, so that peak_rss_mb reports
+    # the peak of the following work only, elsewhere it keeps the peak since
+    # the start of the process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,71 @@
+import time
+
+from memovision.memory import peak_rss_mb
+
+# processors are built once per process and reused by every request, job
+# and pool task running in it (forked pool workers inherit loaded models)
+factories = {}
+models = {}
+stats = {}
+
+
+def register_model(name, factory):
+    factories[name] = factory
+
+
+def get_model(name):
+    if name not in models:
+        load_model(name)
+    return models[name]
+
+
+def load_model(name):
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    models[name] = factories[name]()
+    rss_after = peak_rss_mb()
+    stats[name] = {
+        'load_time_sec': round(time.perf_counter() - start, 3),
+        'peak_rss_increase_mb':
+        None if rss_before is None else round(rss_after - rss_before, 2),
+        'uses': 0
+    }
+    return models[name]
+
+
+def use_model(name):
+    model = get_model(name)
+    stats[name]['uses'] += 1
+    return model
+
+
+def warm_up(names=None):
+    for name in names or factories:
+        get_model(name)
+
+
+def model_stats():
+    return {
+        name: dict(stats.get(name, {}), loaded=name in models)
+        for name in factories
+    }
+
+
+def deep_chroma_processor():
+    from madmom.audio.chroma import DeepChromaProcessor
+    return DeepChromaProcessor()
+
+
+def chord_recognition_processor():
+    from madmom.features.chords import DeepChromaChordRecognitionProcessor
+    return DeepChromaChordRecognitionProcessor()
+
+
+def beat_activation_processor():
+    from madmom.features.beats import RNNBeatProcessor
+    return RNNBeatProcessor()
+
+
+register_model('deep_chroma', deep_chroma_processor)
+register_model('chord_recognition', chord_recognition_processor)
+register_model('beat_activation', beat_activation_processor)
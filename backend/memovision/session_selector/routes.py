@@ -4,6 +4,7 @@ from datetime import datetime
 
 from flask import Blueprint, jsonify, request
 from flask_jwt_extended import current_user, jwt_required
+from memovision.blob_store import release_blob
 from memovision.db_models import Session
 
 from memovision import db
@@ -69,9 +70,12 @@ def delete_session():
     session_name = req['sessionName']
     session = Session.query.filter_by(name=session_name,
                                       user=current_user).first()
+    content_hashes = set(track.content_hash for track in session.tracks)
     db.session.delete(session)
     db.session.commit()
     filepath = f'./user_uploads/{current_user.username}/{session_name}/'
     if os.path.exists(filepath):
         shutil.rmtree(filepath)
+    for content_hash in content_hashes:
+        release_blob(current_user, content_hash)
     return jsonify({'message': 'success'})
@@ -0,0 +1,293 @@
+import numpy as np
+from synctoolbox.dtw.core import compute_warping_path
+from synctoolbox.dtw.cost import cosine_distance
+from synctoolbox.dtw.utils import (compute_optimal_chroma_shift,
+                                   shift_chroma_vectors)
+from synctoolbox.feature.utils import normalize_feature
+
+from memovision.blob_store import (artifact_key, fetch_artifact,
+                                   store_artifact)
+from memovision.duplicate_finder.functions import run_structure_checker
+from memovision.helpers.functions import (compute_cens, compute_dtw_path,
+                                          feature_rate, preview_feature_rate,
+                                          profile_chroma_shifts, step_weights,
+                                          transfer_step_annotations)
+from memovision.memory import peak_rss_mb, reset_peak_rss
+from memovision.warping_path import (WP_FILENAME, load_dense_path,
+                                     load_time_map, save_warping_path,
+                                     time_map)
+
+# reference of the pool process, set once by the pool initializer
+pool_reference = {}
+
+# composed paths are refined where their slope over one second leaves
+# [1 / COMPOSE_MAX_SLOPE, COMPOSE_MAX_SLOPE]
+COMPOSE_WINDOW = 50
+COMPOSE_MAX_SLOPE = 4
+# chroma is normalized like sync_via_mrmsdtw does before a dtw
+CHROMA_NORM_ORD = 2
+CHROMA_NORM_THRESHOLD = 0.001
+
+
+def track_dir(username, track):
+    return f'./user_uploads/{username}/{track.session.name}/{track.filename}'
+
+
+def load_cens(features_dir, chroma=None):
+    # cens is stored by the chroma pipeline, older tracks only have chroma
+    try:
+        return np.load(f'{features_dir}/cens.npy')
+    except FileNotFoundError:
+        if chroma is None:
+            chroma = np.load(f'{features_dir}/chroma.npy')
+        return compute_cens(chroma)
+
+
+def chroma_shifts(ref, targets):
+    # vectorized over all targets, None where the dtw fallback is needed
+    if ref.chroma_profile is None:
+        return [None] * len(targets)
+    known = [i for i, t in enumerate(targets) if t.chroma_profile is not None]
+    shifts = [None] * len(targets)
+    if known:
+        profiles = np.array([targets[i].chroma_profile for i in known])
+        for i, shift in zip(
+                known,
+                profile_chroma_shifts(np.array(ref.chroma_profile),
+                                      profiles)):
+            shifts[i] = shift
+    return shifts
+
+
+def load_reference(username, track, precise=False):
+    """Load the reference features shared by all synchronized targets.
+            Returns
+            -------
+            ref : dict
+                Chroma, its CENS, optional onset activation function,
+                content hash and length of the reference
+            """
+    features_dir = f'{track_dir(username, track)}/features'
+    chroma = np.load(f'{features_dir}/chroma.npy')
+    onset = np.load(f'{features_dir}/beatfun.npy') if precise else None
+    return {
+        'chroma': chroma,
+        'cens': load_cens(features_dir, chroma),
+        'onset': onset,
+        'content_hash': track.content_hash,
+        'length_sec': track.length_sec
+    }
+
+
+def set_pool_reference(ref):
+    pool_reference.update(ref)
+
+
+def sync_target(ref,
+                username,
+                target_dir,
+                content_hash,
+                length_sec,
+                precise=False,
+                chroma_shift=None,
+                preview=False,
+                memory_budget_mb=None):
+    """Synchronize a target with a reference, without database access.
+            Writes wp.npz and steps.txt of the target.
+
+            Returns
+            -------
+            result : dict
+                Feature rate of the path and the peak resident memory of
+                the process while computing it in megabytes, None for paths
+                from the store
+            """
+    peak_memory_mb = None
+    resolution = preview_feature_rate if preview else feature_rate
+    precise = precise and not preview
+    features_dir = f'{target_dir}/features'
+    wp_path = f'{features_dir}/{WP_FILENAME}'
+    # a path between the same two recordings may already exist in another session
+    wp_key = artifact_key(WP_FILENAME,
+                          ref=ref['content_hash'],
+                          precise=bool(precise),
+                          feature_rate=resolution)
+    if not (ref['content_hash'] and fetch_artifact(username, content_hash,
+                                                   wp_key, wp_path)):
+        target_chroma = np.load(f'{target_dir}/features/chroma.npy')
+        target_cens = None
+        if chroma_shift is None:
+            target_cens = load_cens(f'{target_dir}/features', target_chroma)
+        target_onset = None
+        if precise:
+            target_onset = np.load(f'{target_dir}/features/beatfun.npy')
+        # the dtw buffers are allocated by numba, which only the resident
+        # memory of the process accounts for
+        reset_peak_rss()
+        wp = compute_dtw_path(ref_chroma=ref['chroma'],
+                              target_chroma=target_chroma,
+                              ref_onset=ref['onset'],
+                              target_onset=target_onset,
+                              with_onsets=precise,
+                              ref_cens=ref['cens'],
+                              target_cens=target_cens,
+                              chroma_shift=chroma_shift,
+                              preview=preview,
+                              memory_budget_mb=memory_budget_mb)
+        peak_memory_mb = peak_rss_mb()
+        if peak_memory_mb is not None:
+            peak_memory_mb = round(peak_memory_mb, 1)
+        save_warping_path(features_dir, wp, feature_rate=resolution)
+        if ref['content_hash']:
+            store_artifact(username, content_hash, wp_key, wp_path)
+    save_steps(target_dir, ref['length_sec'], length_sec)
+    return {'resolution': resolution, 'peak_memory_mb': peak_memory_mb}
+
+
+def save_steps(target_dir, ref_length_sec, length_sec):
+    # transfer step annotations
+    steps = transfer_step_annotations(10, ref_length_sec, length_sec,
+                                      load_time_map(f'{target_dir}/features'))
+    np.savetxt(f'{target_dir}/annotations/steps.txt', steps, fmt='%.5f')
+
+
+def sync_pool_target(*args):
+    return sync_target(pool_reference, *args)
+
+
+def check_target_structure(ref_filename, filename, features_dir):
+    # diff regions of one target as returned by the structure checker, None
+    # if it follows the structure of the reference
+    _, diff_regions_list = run_structure_checker(
+        ref_filename, [filename], [load_dense_path(features_dir)])
+    return diff_regions_list[0] if diff_regions_list else None
+
+
+def compose_paths(map_old_new, map_old_target, feature_rate=50):
+    """Path from a new reference to a target via the previous reference.
+            Parameters
+            ----------
+            map_old_new : tuple
+                Stored time map from the previous to the new reference
+
+            map_old_target : tuple
+                Stored time map from the previous reference to the target
+
+            Returns
+            -------
+            wp : np.ndarray
+                Path of shape (2, N) in frames with one entry per frame of
+                the new reference
+            """
+    old_times, new_times = map_old_new
+    new_frames = np.arange(int(round(new_times[-1] * feature_rate)) + 1)
+    # the inverse of a monotone time map is the map with swapped axes
+    old_ref_times = np.interp(new_frames / feature_rate, new_times,
+                              old_times)
+    target_times = np.interp(old_ref_times, *map_old_target)
+    return np.vstack([new_frames, target_times * feature_rate])
+
+
+def ill_conditioned_segments(wp, window=COMPOSE_WINDOW,
+                             max_slope=COMPOSE_MAX_SLOPE):
+    # frame ranges of the new reference where the composed path is too
+    # steep or too flat to be trusted
+    if wp.shape[1] <= window:
+        return []
+    slope = (wp[1, window:] - wp[1, :-window]) / window
+    bad = np.zeros(wp.shape[1], dtype=bool)
+    for start in np.flatnonzero((slope > max_slope) |
+                                (slope < 1 / max_slope)):
+        bad[start:start + window + 1] = True
+    edges = np.diff(np.concatenate([[0], bad.astype(int), [0]]))
+    return list(zip(np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)))
+
+
+def refine_segment(wp, start, end, ref_chroma, target_chroma,
+                   pad=COMPOSE_WINDOW):
+    # replace a segment of a composed path by a local dtw between anchors
+    # taken from the trusted parts of the path around it
+    start = max(start - pad, 0)
+    end = min(end + pad, wp.shape[1] - 1)
+    t_start = int(np.floor(wp[1, start]))
+    t_end = min(int(np.ceil(wp[1, end])), target_chroma.shape[1] - 1)
+    if end <= start or t_end <= t_start:
+        return wp
+    C = cosine_distance(
+        normalize_feature(ref_chroma[:, start:end + 1],
+                          norm_ord=CHROMA_NORM_ORD,
+                          threshold=CHROMA_NORM_THRESHOLD),
+        normalize_feature(target_chroma[:, t_start:t_end + 1],
+                          norm_ord=CHROMA_NORM_ORD,
+                          threshold=CHROMA_NORM_THRESHOLD))
+    _, _, local_wp = compute_warping_path(
+        C,
+        step_sizes=np.array([[1, 0], [0, 1], [1, 1]]),
+        step_weights=step_weights)
+    x, y = time_map(local_wp)
+    wp[1, start:end + 1] = t_start + np.interp(np.arange(end - start + 1), x,
+                                               y)
+    return wp
+
+
+def switch_reference(username, tracks, new_ref, refine=True):
+    """Derive paths to a new reference from the paths to the previous one.
+            Tracks without a stored path lose their sync flag and are left
+            for the next synchronization.
+
+            Parameters
+            ----------
+            username : str
+                Owner of the session
+
+            tracks : list
+                All tracks of the session, including both references
+
+            new_ref : Track
+                New reference, its stored path leads from the previous one
+
+            refine : bool
+                Refine ill-conditioned parts of the composed paths via dtw
+            """
+    if not new_ref.sync:
+        for track in tracks:
+            track.sync = False
+            track.sync_resolution = None
+        return
+    new_dir = track_dir(username, new_ref)
+    map_old_new = load_time_map(f'{new_dir}/features')
+    new_chroma = np.load(f'{new_dir}/features/chroma.npy')
+    new_cens = None
+    new_resolution = new_ref.sync_resolution or feature_rate
+    shifts = chroma_shifts(new_ref, tracks)
+    for track, shift in zip(tracks, shifts):
+        if not track.sync:
+            continue
+        target_dir = track_dir(username, track)
+        if track is new_ref:
+            frames = np.arange(new_chroma.shape[1])
+            wp = np.vstack([frames, frames])
+            track.sync_resolution = feature_rate
+        else:
+            wp = compose_paths(map_old_new,
+                               load_time_map(f'{target_dir}/features'))
+            segments = ill_conditioned_segments(wp) if refine else []
+            if segments:
+                target_chroma = np.load(f'{target_dir}/features/chroma.npy')
+                if shift is None:
+                    if new_cens is None:
+                        new_cens = load_cens(f'{new_dir}/features',
+                                             new_chroma)
+                    shift = compute_optimal_chroma_shift(
+                        new_cens,
+                        load_cens(f'{target_dir}/features', target_chroma))
+                target_chroma = shift_chroma_vectors(target_chroma, shift)
+                for start, end in segments:
+                    wp = refine_segment(wp, start, end, new_chroma,
+                                        target_chroma)
+            wp[1] = np.maximum.accumulate(wp[1])
+            # a composed path is only as fine as the coarser of the two
+            track.sync_resolution = min(
+                track.sync_resolution or feature_rate, new_resolution)
+        save_warping_path(f'{target_dir}/features', wp)
+        save_steps(target_dir, new_ref.length_sec, track.length_sec)
@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+
+from memovision.blob_store import unshare
+
+# warping paths are stored as the knots of a piecewise linear time map,
+# interpolating between the knots deviates from the dense path by at most
+# WP_MAX_ERROR_SEC on the target axis (up to float32 rounding)
+WP_FILENAME = 'wp.npz'
+LEGACY_WP_FILENAME = 'wp.npy'
+WP_MAX_ERROR_SEC = 0.02
+
+
+def time_map(wp):
+    # monotone map from the first row of a path to the second, frames that
+    # are visited repeatedly are mapped to their mean position
+    x, inverse = np.unique(wp[0], return_inverse=True)
+    y = np.bincount(inverse, weights=wp[1]) / np.bincount(inverse)
+    return x, y
+
+
+def simplify_time_map(x, y, max_error):
+    # ramer-douglas-peucker with the error measured along the target axis,
+    # which is the error of the interpolated time map
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    segments = [(0, len(x) - 1)]
+    while segments:
+        first, last = segments.pop()
+        if last - first < 2:
+            continue
+        inner = slice(first + 1, last)
+        line = y[first] + (y[last] - y[first]) * (x[inner] - x[first]) / (
+            x[last] - x[first])
+        error = np.abs(y[inner] - line)
+        worst = np.argmax(error)
+        if error[worst] > max_error:
+            split = first + 1 + worst
+            keep[split] = True
+            segments.extend([(first, split), (split, last)])
+    return x[keep], y[keep]
+
+
+def save_warping_path(features_dir,
+                      wp,
+                      feature_rate=50,
+                      max_error=WP_MAX_ERROR_SEC):
+    """Store a warping path as a simplified time map.
+            Parameters
+            ----------
+            features_dir : str
+                Features folder of the target track
+
+            wp : np.ndarray
+                Path of shape (2, N) in frames, reference frames first
+
+            feature_rate : float
+                Frame rate of the path
+
+            max_error : float
+                Maximal deviation of the stored map from the path in seconds
+            """
+    x, y = time_map(wp)
+    ref_times, target_times = simplify_time_map(x / feature_rate,
+                                                y / feature_rate, max_error)
+    path = f'{features_dir}/{WP_FILENAME}'
+    unshare(path)
+    with open(path, 'wb') as f:
+        np.savez(f,
+                 ref_times=ref_times.astype(np.float32),
+                 target_times=target_times.astype(np.float32))
+    # drop the dense path written by older versions
+    legacy_path = f'{features_dir}/{LEGACY_WP_FILENAME}'
+    if os.path.exists(legacy_path):
+        os.remove(legacy_path)
+    return path
+
+
+def has_warping_path(features_dir):
+    return os.path.exists(f'{features_dir}/{WP_FILENAME}') or os.path.exists(
+        f'{features_dir}/{LEGACY_WP_FILENAME}')
+
+
+def warping_path_version(features_dir):
+    # changes whenever the stored path is rewritten, None without a path
+    for filename in (WP_FILENAME, LEGACY_WP_FILENAME):
+        try:
+            stat = os.stat(f'{features_dir}/{filename}')
+        except FileNotFoundError:
+            continue
+        return f'{filename}:{stat.st_mtime_ns}:{stat.st_size}'
+    return None
+
+
+def load_time_map(features_dir):
+    """Load the time map of a stored warping path.
+            Returns
+            -------
+            ref_times, target_times : np.ndarray
+                Knots of the map in seconds, ready for np.interp
+            """
+    path = f'{features_dir}/{WP_FILENAME}'
+    if os.path.exists(path):
+        with np.load(path) as data:
+            return (data['ref_times'].astype(np.float64),
+                    data['target_times'].astype(np.float64))
+    # dense 50 fps path written by older versions
+    x, y = time_map(np.load(f'{features_dir}/{LEGACY_WP_FILENAME}'))
+    return x / 50, y / 50
+
+
+def load_dense_path(features_dir, feature_rate=50):
+    # path with one entry per reference frame for frame based consumers
+    ref_times, target_times = load_time_map(features_dir)
+    frames = np.arange(int(round(ref_times[-1] * feature_rate)) + 1)
+    return np.vstack(
+        [frames,
+         np.interp(frames / feature_rate, ref_times, target_times) *
+         feature_rate])
@@ -0,0 +1,146 @@
+import os
+import struct
+
+import numpy as np
+
+# audiowaveform renders the finest level, coarser levels are reduced from it
+BASE_SAMPLES_PER_PIXEL = 32
+PYRAMID_FACTORS = [8, 64]
+
+FLAG_8_BIT = 0x1
+
+
+def level_path(base_path, samples_per_pixel):
+    if samples_per_pixel == BASE_SAMPLES_PER_PIXEL:
+        return base_path
+    return base_path[:-4] + f'_z{samples_per_pixel}.dat'
+
+
+def read_waveform(path):
+    """Read an audiowaveform .dat file.
+            Returns
+            -------
+            header : dict
+                version, flags, sample_rate, samples_per_pixel, length and channels
+            data : np.memmap
+                Min/max pairs of shape (length, channels, 2)
+            """
+    with open(path, 'rb') as f:
+        version, flags, sample_rate, samples_per_pixel, length = struct.unpack(
+            '<iIiiI', f.read(20))
+        channels = 1
+        if version == 2:
+            channels = struct.unpack('<i', f.read(4))[0]
+        offset = f.tell()
+    header = {
+        'version': version,
+        'flags': flags,
+        'sample_rate': sample_rate,
+        'samples_per_pixel': samples_per_pixel,
+        'length': length,
+        'channels': channels
+    }
+    dtype = np.int8 if flags & FLAG_8_BIT else np.dtype('<i2')
+    data = np.memmap(path,
+                     dtype=dtype,
+                     mode='r',
+                     offset=offset,
+                     shape=(length, channels, 2))
+    return header, data
+
+
+def write_waveform(path, header, data):
+    with open(path, 'wb') as f:
+        f.write(
+            struct.pack('<iIiiI', header['version'], header['flags'],
+                        header['sample_rate'], header['samples_per_pixel'],
+                        data.shape[0]))
+        if header['version'] == 2:
+            f.write(struct.pack('<i', data.shape[1]))
+        f.write(np.ascontiguousarray(data).tobytes())
+
+
+def reduce_peaks(data, boundaries):
+    # merge the pixels between consecutive boundaries into one min/max pair
+    mins = np.minimum.reduceat(data[..., 0], boundaries, axis=0)
+    maxs = np.maximum.reduceat(data[..., 1], boundaries, axis=0)
+    return np.stack([mins, maxs], axis=-1)
+
+
+def build_pyramid(base_path):
+    header, data = read_waveform(base_path)
+    paths = []
+    for factor in PYRAMID_FACTORS:
+        level_header = dict(header)
+        level_header['samples_per_pixel'] = header[
+            'samples_per_pixel'] * factor
+        boundaries = np.arange(0, header['length'], factor)
+        level = reduce_peaks(data, boundaries) if len(boundaries) else data[:0]
+        path = level_path(base_path, level_header['samples_per_pixel'])
+        write_waveform(path, level_header, level)
+        paths.append(path)
+    return paths
+
+
+def pyramid_paths(base_path):
+    return [
+        level_path(base_path, BASE_SAMPLES_PER_PIXEL * factor)
+        for factor in PYRAMID_FACTORS
+    ]
+
+
+def select_level(base_path, samples_per_pixel):
+    # coarsest stored level that is still at least as detailed as requested
+    levels = [BASE_SAMPLES_PER_PIXEL] + [
+        BASE_SAMPLES_PER_PIXEL * factor for factor in PYRAMID_FACTORS
+    ]
+    if any(not os.path.exists(path) for path in pyramid_paths(base_path)):
+        build_pyramid(base_path)
+    candidates = [level for level in levels if level <= samples_per_pixel]
+    level = max(candidates) if candidates else BASE_SAMPLES_PER_PIXEL
+    return level_path(base_path, level)
+
+
+def waveform_peaks(base_path, start_time, end_time, pixels_per_second):
+    """Peaks of a time range at the requested horizontal resolution.
+            Parameters
+            ----------
+            base_path : str
+                Path to the finest .dat level rendered by audiowaveform
+
+            start_time, end_time : float
+                Time range in seconds
+
+            pixels_per_second : float
+                Requested resolution
+
+            Returns
+            -------
+            peaks : dict
+                Resolution of the returned data and min/max values per channel
+            """
+    header, _ = read_waveform(base_path)
+    target_spp = header['sample_rate'] / pixels_per_second
+    header, data = read_waveform(select_level(base_path, target_spp))
+    spp = header['samples_per_pixel']
+    sr = header['sample_rate']
+    first = min(max(int(start_time * sr / spp), 0), header['length'])
+    last = min(max(int(np.ceil(end_time * sr / spp)), first),
+               header['length'])
+    # pixel edges of the requested resolution mapped onto the stored level
+    num_pixels = max(int(round((last - first) * spp / target_spp)), 1)
+    boundaries = np.unique(
+        np.linspace(0, last - first, num_pixels, endpoint=False).astype(int))
+    peaks = reduce_peaks(data[first:last],
+                         boundaries) if last > first else data[:0]
+    return {
+        'sampleRate': sr,
+        'samplesPerPixel': (last - first) * spp / max(len(peaks), 1),
+        'startTime': first * spp / sr,
+        'endTime': last * spp / sr,
+        'bits': 8 if header['flags'] & FLAG_8_BIT else 16,
+        'channels': [{
+            'min': peaks[:, ch, 0].tolist(),
+            'max': peaks[:, ch, 1].tolist()
+        } for ch in range(header['channels'])]
+    }
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+# skipped where the audio dependencies of the backend are not installed
+functions = pytest.importorskip('memovision.helpers.functions')
+
+
+def random_chroma(rng, num_frames):
+    chroma = np.abs(rng.normal(size=(12, num_frames)))**4
+    return chroma / chroma.sum(axis=0)
+
+
+@pytest.fixture
+def chroma_pair():
+    # the target is the reference played 10% slower
+    rng = np.random.default_rng(0)
+    ref = random_chroma(rng, 3000)
+    target_idx = np.clip((np.arange(3300) / 1.1).astype(int), 0, 2999)
+    return ref, ref[:, target_idx]
+
+
+@pytest.mark.parametrize('kwargs', [{}, {
+    'memory_budget_mb': 256
+}, {
+    'chroma_shift': 0
+}])
+def test_compute_dtw_path(chroma_pair, kwargs):
+    ref, target = chroma_pair
+    wp = functions.compute_dtw_path(ref, target, **kwargs)
+    assert wp.shape[0] == 2
+    assert wp[0, -1] == ref.shape[1] - 1
+    assert wp[1, -1] == target.shape[1] - 1
+    # the path follows the tempo change up to a couple of frames
+    assert np.abs(wp[1] - 1.1 * wp[0])[50:-50].max() < 5
+
+
+def test_compute_dtw_path_preview(chroma_pair):
+    # the path is computed at the preview feature rate
+    ref, target = chroma_pair
+    wp = functions.compute_dtw_path(ref, target, preview=True)
+    factor = functions.feature_rate // functions.preview_feature_rate
+    assert wp.shape[0] == 2
+    assert wp[0, -1] == ref.shape[1] // factor - 1
+
+
+def test_mrmsdtw_settings_defaults():
+    settings = functions.mrmsdtw_settings(3000, 3300)
+    assert settings['win_len_smooth'][-1] == 1
+    assert settings['downsamp_smooth'][-1] == 1
+
+
+def test_mrmsdtw_settings_long_tracks():
+    # a pair of 4 hour tracks fits with coarser levels above the defaults
+    num_frames = 4 * 3600 * functions.feature_rate
+    settings = functions.mrmsdtw_settings(num_frames,
+                                          num_frames,
+                                          memory_budget_mb=4096)
+    assert settings['downsamp_smooth'][-1] == 1
+    assert len(settings['downsamp_smooth']) > len(functions.downsamp_smooth)
+
+
+def test_mrmsdtw_settings_budget_too_small():
+    num_frames = 4 * 3600 * functions.feature_rate
+    with pytest.raises(MemoryError, match='memory_budget_mb'):
+        functions.mrmsdtw_settings(num_frames,
+                                   num_frames,
+                                   memory_budget_mb=512)
@@ -0,0 +1,6 @@
+from memovision.app_config import Config
+from memovision.jobs.queue import start_workers
+
+if __name__ == '__main__':
+    start_workers(num_workers=Config.JOB_WORKERS,
+                  poll_interval=Config.JOB_POLL_INTERVAL)
@@ -1,7 +1,7 @@
 import { api } from '../../../axiosInstance';
 import { useAudioStore, useMeasureData, useRegionData, useTracksFromDb, useUserInfo } from '../../../globalStores';
 import { pinia } from '../../../piniaInstance';
-import { getSecureConfig } from '../../../sharedFunctions';
+import { getSecureConfig, sleep } from '../../../sharedFunctions';
 import { numComputed } from './variables';
 
 /* pinia stores */
@@ -21,6 +21,7 @@ const userInfo = useUserInfo(pinia);
     getMetronomeClick – fetches the metronome audio clip
     getSyncPoints – fetches synchronization matrices
     getTrackData – fetches objects with track metadata
+    waitForChords – refetches chord annotations once their background job has finished
 
 */
 
@@ -101,6 +102,22 @@ async function getChords() {
     const res = await api.get('/chords', getSecureConfig());
     const chordsList = res.data.chordsList;
     regionData.chords = chordsList;
+    // chords of the reference are computed in the background, they are
+    // fetched again once the job has finished without blocking the caller
+    if (res.data.jobId) waitForChords(res.data.jobId);
+}
+
+async function waitForChords(jobId) {
+    while (true) {
+        await sleep(2000);
+        const res = await api.get(`/jobs/${jobId}`, getSecureConfig());
+        const job = res.data.job;
+        if (job.status === 'failed') return;
+        if (job.status === 'done') {
+            if (job.files.every((f) => f.status !== 'failed')) await getChords();
+            return;
+        }
+    }
 }
 
 export {
@@ -42,13 +42,14 @@ const regionData = useRegionData(pinia);
 /*  fetch functions description
     
     checkStructure – checks if the particular track has the same musical structure as the reference
-    computeActFunc – computes beat tracking activation function via conv net
+    computeActFunc – computes beat tracking activation function via madmom's rnn
     computeAllChromas – computes chroma representations for all tracks
     computeAllFeatures – computes all available audio features
     computeChroma – computes chroma representation for a single track
     deleteDiffStructureTracks – deletes the tracks with differences in musical structure
     deleteDuplicates – deletes duplicate recordings (if there are any)
     findDuplicates – searches for pairs of duplicate recordings
+    followJobProgress – polls a background job and updates the progress bar
     getAllFeatures – fetches all computed features from the server
     getFeatureNames – returns names of all available features
     keepDiffStructureTracks – keeps the tracks with differences in musical structure
@@ -70,12 +71,20 @@ async function computeChroma(filename) {
 
 async function computeAllChromas() {
     resetProgress();
-    let chromas = [];
-    tracksFromDb.trackObjects.forEach((obj) => {
-        chromas.push(computeChroma(obj.filename));
-    });
-    numThingsToCompute.value = chromas.length;
-    await Promise.all(chromas);
+    // all tracks without chroma are computed in one background job
+    const res = await api.put('/compute-chroma-session', {}, getSecureConfig());
+    await followJobProgress(res.data.jobId);
+}
+
+async function followJobProgress(jobId) {
+    while (true) {
+        const res = await api.get(`/jobs/${jobId}`, getSecureConfig());
+        const job = res.data.job;
+        numThingsToCompute.value = Math.max(job.files.length, 1);
+        numComputed.value = job.files.filter((f) => f.status !== 'queued').length;
+        if (job.status === 'done' || job.status === 'failed') return job;
+        await sleep(1000);
+    }
 }
 
 async function findDuplicates() {
@@ -200,18 +209,17 @@ async function getAllFeatures() {
 async function synchronizeTracks() {
     loadingMessage.value = 'Synchronizing tracks...';
     if (preciseSync.value) {
-        let actFuncPromises = [];
-        tracksFromDb.trackObjects.forEach((obj) => {
-            actFuncPromises.push(computeActFunc(obj.filename));
-        });
-        await Promise.all(actFuncPromises);
+        // activation functions of all tracks are computed in one background job
+        const actFuncRes = await api.put('/compute-act-func-session', {}, getSecureConfig());
+        await followJobProgress(actFuncRes.data.jobId);
+        resetProgress();
     }
-    let syncPromises = [];
-    tracksFromDb.trackObjects.forEach((obj) => {
-        syncPromises.push(syncTrack(obj.filename, preciseSync.value));
+    // unsynced tracks are synchronized to the reference in one background job
+    const res = await api.put('/sync-session', { precise: preciseSync.value }, getSecureConfig());
+    const job = await followJobProgress(res.data.jobId);
+    job.files.forEach((f) => {
+        if (f.status === 'ready') tracksFromDb.trackObjects[tracksFromDb.getIdx(f.filename)].sync = true;
     });
-    numThingsToCompute.value = syncPromises.length;
-    await Promise.all(syncPromises);
     await transferAllMeasures();
     await getMeasureData();
     await getSyncPoints();
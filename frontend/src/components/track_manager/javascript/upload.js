@@ -1,8 +1,8 @@
 import { showAlert } from '../../../alerts';
 import { api } from '../../../axiosInstance';
-import { useTracksFromDb, useUserInfo } from '../../../globalStores';
+import { useTracksFromDb } from '../../../globalStores';
 import { pinia } from '../../../piniaInstance';
-import { availableSpace, getCookie, getSecureConfig } from '../../../sharedFunctions';
+import { availableSpace, getCookie, getSecureConfig, sleep } from '../../../sharedFunctions';
 import { getAudioData, getMeasureData, getTrackData } from './fetch';
 import { transferAllMeasures } from './process';
 import { isUploading, somethingToUpload, uploadList } from './variables';
@@ -10,18 +10,23 @@ import { isUploading, somethingToUpload, uploadList } from './variables';
 /* pinia stores */
 
 const tracksFromDb = useTracksFromDb(pinia);
-const userInfo = useUserInfo(pinia);
+
+const uploadChunkSize = 8 * 1024 * 1024;
+const uploadMaxRetries = 5;
 
 /*  upload functions description 
     
     addFilesToUploadList – adds files to the upload list
     clearUploadList – removes all files from the upload list
+    fileFingerprint – identifies a file for resuming its upload
     preUploadCheck – returns true if the file with a given filename is already uploaded
     removeFileFromUploadList – removes file from the upload list
     uploadAllFiles – uploads all the files from the upload list
+    uploadInChunks – uploads a file in resumable chunks
     uploadMeasures – uploads manual measure annotations
     uploadMetadata – uploads metadata to the server
     uploadOneFile – uploads one file to the server
+    waitForJob – polls a background job until it is finished
 
 */
 
@@ -84,29 +89,88 @@ function clearUploadList() {
     }
 }
 
+async function waitForJob(jobId, timeoutMs = 30 * 60 * 1000) {
+    // jobs of crashed workers are failed by the server, the timeout covers
+    // jobs that are never picked up because no worker is running
+    const deadline = Date.now() + timeoutMs;
+    while (true) {
+        const res = await api.get(`/jobs/${jobId}`, getSecureConfig());
+        const job = res.data.job;
+        if (job.status === 'done' || job.status === 'failed') return job;
+        if (Date.now() > deadline) return { ...job, status: 'failed' };
+        await sleep(1000);
+    }
+}
+
+async function fileFingerprint(file) {
+    // identifies the file across page reloads without reading all of it
+    const head = await file.slice(0, 1024 * 1024).arrayBuffer();
+    let headHash = '';
+    if (window.crypto && window.crypto.subtle) {
+        const digest = await window.crypto.subtle.digest('SHA-256', head);
+        headHash = Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+    }
+    return `${file.size}-${file.lastModified}-${headHash}`;
+}
+
+async function uploadInChunks(fileObject) {
+    // resumable upload, every chunk is acknowledged by the server and an
+    // interrupted upload of the same file continues from the last chunk
+    const file = fileObject.file;
+    const data = {
+        filename: file.name,
+        size: file.size,
+        fingerprint: await fileFingerprint(file),
+    };
+    const initRes = await api.post('/upload-init', data, getSecureConfig());
+    let upload = initRes.data.upload;
+    const chunkConfig = getSecureConfig();
+    chunkConfig.headers['Content-Type'] = 'application/octet-stream';
+    let retries = 0;
+    while (upload.offset < upload.totalSize) {
+        const chunk = file.slice(upload.offset, upload.offset + uploadChunkSize);
+        try {
+            const res = await api.put(`/upload-chunk/${upload.uploadId}?offset=${upload.offset}`, chunk, chunkConfig);
+            upload = res.data.upload;
+            retries = 0;
+        } catch (error) {
+            if (error.response && error.response.status === 409) {
+                // continue from the offset acknowledged by the server
+                upload = error.response.data.upload;
+                continue;
+            }
+            retries += 1;
+            if (retries > uploadMaxRetries) throw error;
+            await sleep(1000 * retries);
+            const res = await api.get(`/upload-chunk/${upload.uploadId}`, getSecureConfig());
+            upload = res.data.upload;
+        }
+        fileObject.progressPercentage = Math.round((100 * upload.offset) / upload.totalSize);
+    }
+    fileObject.beingConverted = true;
+    return await api.post(`/upload-finalize/${upload.uploadId}`, {}, getSecureConfig());
+}
+
 async function uploadOneFile(fileObject) {
     if (!fileObject.beingUploaded) {
         fileObject.beingUploaded = true;
-        let formData = new FormData();
-        formData.append('file', fileObject.file);
-        formData.append('availableSpace', userInfo.availableSpace);
-        function fileUploadProgress(event) {
-            const percentage = Math.round((100 * event.loaded) / event.total);
-            fileObject.progressPercentage = percentage;
-            if (percentage === 100) fileObject.beingConverted = true;
+        let res;
+        try {
+            res = await uploadInChunks(fileObject);
+        } catch (error) {
+            removeFileFromUploadList(fileObject.file.name);
+            showAlert(`Could not upload track: ${fileObject.file.name}`, 2000);
+            return;
         }
-        const axiosConfig = {
-            headers: {
-                'X-CSRF-TOKEN': getCookie('csrf_access_token'),
-                'Content-Type': 'multipart/form-data',
-            },
-            onUploadProgress: fileUploadProgress,
-        };
-        const res = await api.post('/upload-audio-file', formData, axiosConfig);
+        const job = await waitForJob(res.data.jobId);
         await availableSpace();
         removeFileFromUploadList(fileObject.file.name);
-        tracksFromDb.addTrackData(res.data.obj);
-        await getAudioData(res.data.obj.filename);
+        if (job.status === 'failed') {
+            showAlert(`Could not convert track: ${res.data.obj.filename}`, 2000);
+            return;
+        }
+        tracksFromDb.addTrackData(job.track);
+        await getAudioData(job.track.filename);
     }
 }
 